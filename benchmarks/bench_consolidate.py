@@ -0,0 +1,120 @@
+"""Benchmark each dataset's consolidate action on synthetic downloads.
+
+Writes synthetic copies of every dataset, with the builders the tests
+use, at each of several sizes and times fd's consolidate actions over
+them.  Each action runs in a fresh process so its peak memory can be
+measured, and nothing is downloaded:
+
+    $ python benchmarks/bench_consolidate.py --rows 100000 1000000
+
+Reports rows/s and MB/s, of uncompressed input, and peak RSS; --json
+saves the results for comparing against a later run.
+"""
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from zipfile import ZipFile
+
+root = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(root), str(root / 'tests')]
+import fd                                                       # noqa: E402
+from synthetic import make_fddir                                # noqa: E402
+
+datasets = ['bls:cew', 'bls:ce', 'bls:sm', 'epa:ucmr']
+
+
+def input_bytes(d):
+    """Uncompressed bytes of the downloaded files in dataset directory d."""
+    total = 0
+    for p in d.iterdir():
+        if p.name.startswith('.') or not p.is_file():
+            continue
+        if p.suffix == '.zip':
+            with ZipFile(str(p)) as z:
+                total += sum(info.file_size for info in z.infolist())
+        else:
+            total += p.stat().st_size
+    return total
+
+
+def child(ad, directory, fmt, jobs):
+    """Consolidate ad under fd directory, then print its measurements."""
+    fd.args = argparse.Namespace(quiet=True, format=fmt, jobs=jobs,
+                                 rebuild=True)
+    start = time.perf_counter()
+    cpu = time.process_time()
+    fd.actions[ad.replace(':', '_') + '_consolidate'](Path(directory))
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    d = Path(directory).joinpath(*ad.split(':'))
+    with (d / fd.consolidate_manifest_name).open() as f:
+        sources = json.load(f)[fmt]['sources']
+    rows = sum(s['slice']['rows'] for s in sources.values() if s['slice'])
+    print(json.dumps({'seconds': seconds, 'cpu': cpu, 'rows': rows,
+                      'peak_rss': peak_rss()}))
+
+
+def peak_rss():
+    """Peak resident set size of this process and its children, in bytes."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    try:
+        # Linux carries ru_maxrss over exec, so ask for this program's own
+        with open('/proc/self/status') as f:
+            hwm = next(line for line in f if line.startswith('VmHWM:'))
+        return max(int(hwm.split()[1]), children) * 2**10
+    except OSError:
+        # ru_maxrss is in bytes on macOS
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   children)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='approximate data rows per dataset, per run')
+    parser.add_argument('--datasets', nargs='+', default=datasets,
+                        choices=datasets)
+    parser.add_argument('--format', default='csv', choices=sorted(fd.outputs))
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--json', type=Path, help='save results to this file')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child, args.format, args.jobs)
+
+    results = []
+    print('{0:9s} {1:>10s} {2:>13s} {3:>9s} {4:>8s} {5:>8s} {6:>9s}'.format(
+        'dataset', 'rows', 'rows/s', 'MB/s', 'seconds', 'cpu', 'peak MB'))
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            make_fddir(Path(tmp), rows)
+            for ad in args.datasets:
+                size = input_bytes(Path(tmp).joinpath(*ad.split(':')))
+                out = subprocess.run(
+                    [sys.executable, __file__, '--child', ad, tmp,
+                     '--format', args.format, '--jobs', str(args.jobs)],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True)
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+                result.update(dataset=ad, format=args.format, jobs=args.jobs,
+                              input_bytes=size,
+                              rows_per_second=result['rows'] / result['seconds'],
+                              mb_per_second=size / 2**20 / result['seconds'])
+                results.append(result)
+                print('{0:9s} {1:10,d} {2:13,.0f} {3:9.1f} {4:8.2f} {5:8.2f} '
+                      '{6:9.0f}'.format(
+                          ad, result['rows'], result['rows_per_second'],
+                          result['mb_per_second'], result['seconds'],
+                          result['cpu'], result['peak_rss'] / 2**20))
+    if args.json:
+        with args.json.open('w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark attaching BLS CE's dimension tables to its data file.
+
+Times the per-chunk pd.merge path fd used to take against the indexed
+dimensions of fd.index_dimension/fd.attach_dimension, over the full
+ce.data.0.AllCESSeries of a downloaded bls:ce directory:
+
+    $ fd download bls:ce
+    $ python benchmarks/bench_join.py ~/fdata/bls/ce
+
+Only the joins are timed; parsing is shared by both paths.
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fd                                                       # noqa: E402
+
+
+def merge_join(chunk, series, period):
+    chunk = pd.merge(chunk, series, how='left', on='series_id')
+    return pd.merge(chunk, period, how='left', on='period')
+
+
+def engine_join(chunk, series, period):
+    chunk = fd.attach_dimension(chunk, series)
+    return fd.attach_dimension(chunk, period)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', type=Path, help='bls:ce download directory')
+    parser.add_argument('--chunksize', type=int, default=10000)
+    parser.add_argument('--check', action='store_true',
+                        help='assert both paths produce identical chunks')
+    args = parser.parse_args()
+    d = args.directory
+
+    series = fd.bls_ce_series(d)
+    period = fd.bls_ce_period(d)
+    start = time.perf_counter()
+    indexed = (fd.index_dimension(series, 'series_id'),
+               fd.index_dimension(period, 'period'))
+    index_time = time.perf_counter() - start
+
+    times = {'merge': 0.0, 'engine': index_time}
+    rows = 0
+    for chunk in pd.read_table(d / 'ce.data.0.AllCESSeries',
+                               chunksize=args.chunksize):
+        rows += len(chunk)
+        start = time.perf_counter()
+        merged = merge_join(chunk, series, period)
+        times['merge'] += time.perf_counter() - start
+        start = time.perf_counter()
+        attached = engine_join(chunk, *indexed)
+        times['engine'] += time.perf_counter() - start
+        if args.check:
+            attached = attached.astype(merged.dtypes).reset_index(drop=True)
+            pd.testing.assert_frame_equal(merged, attached)
+
+    print('{0:,} rows in chunks of {1:,}'.format(rows, args.chunksize))
+    for name, seconds in times.items():
+        print('{0:>7s}: {1:8.2f}s {2:14,.0f} rows/s'.format(
+            name, seconds, rows / seconds))
+    print('speedup: {0:.1f}x'.format(times['merge'] / times['engine']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark parsing each dataset's data files into typed chunks.
+
+Compares letting pandas infer types and converting them afterwards, as
+fd used to, against the reader arguments fd.read_args compiles from each
+dataset's schema.  Point it at an fd directory holding downloads:
+
+    $ python benchmarks/bench_parse.py ~/fdata
+
+Datasets not downloaded there are skipped.
+"""
+import io
+import re
+import sys
+import time
+import argparse
+from pathlib import Path
+from zipfile import ZipFile
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fd                                                       # noqa: E402
+
+
+def sources(root):
+    """Yield (dataset, schema, file name, bytes, read_csv options)."""
+    for z in sorted(root.glob('bls/cew/*.zip')):
+        with ZipFile(str(z)) as zfile:
+            for name in zfile.namelist():
+                if re.search(r'all industries.csv', name):
+                    yield 'bls:cew', fd.bls_cew, name, zfile.read(name), {}
+    for ad, schema, name in [('bls:ce', fd.bls_ce, 'bls/ce/ce.data.0.AllCESSeries'),
+                             ('bls:sm', fd.bls_sm, 'bls/sm/sm.data.1.AllData')]:
+        if (root / name).exists():
+            yield ad, schema, name, (root / name).read_bytes(), {'sep': '\t'}
+    for z, name in [('ucmr-3-occurrence-data.zip', 'UCMR3_All.txt'),
+                    ('ucmr2_occurrencedata_jan12.zip',
+                     'UCMR2_All_OccurrenceData_Jan12.txt')]:
+        if (root / 'epa/ucmr' / z).exists():
+            with ZipFile(str(root / 'epa/ucmr' / z)) as zfile:
+                yield ('epa:ucmr', fd.epa_ucmr, name, zfile.read(name),
+                       {'sep': '\t', 'encoding': 'latin1'})
+
+
+def inferred(data, schema, options, chunksize):
+    """Parse with inferred types, then convert them as fd used to."""
+    dtypes = fd.get_dtypes(schema)
+    for chunk in pd.read_csv(io.BytesIO(data), chunksize=chunksize, **options):
+        chunk.rename(columns=schema.get('rename', {}), inplace=True)
+        for k in dtypes[0] + dtypes[1]:
+            if k in chunk:
+                chunk[k] = pd.to_numeric(chunk[k], errors='coerce')
+        for k in dtypes[2] + dtypes[3]:
+            if k in chunk:
+                chunk[k] = chunk[k].astype(str)
+        yield fd.convert_dtypes(chunk, dtypes)
+
+
+def compiled(data, schema, options, chunksize):
+    """Parse straight to the schema's types with fd.read_args."""
+    dtypes = fd.get_dtypes(schema)
+    args = fd.read_args(schema)
+    for chunk in pd.read_csv(io.BytesIO(data), chunksize=chunksize,
+                             **options, **args):
+        chunk.rename(columns=schema.get('rename', {}), inplace=True)
+        yield fd.convert_dtypes(chunk, dtypes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', type=Path, help='fd directory')
+    parser.add_argument('--chunksize', type=int, default=10000)
+    args = parser.parse_args()
+
+    totals = {}
+    for ad, schema, name, data, options in sources(args.directory):
+        total = totals.setdefault(ad, {'bytes': 0, 'rows': 0})
+        total['bytes'] += len(data)
+        for method in [inferred, compiled]:
+            start = time.perf_counter()
+            rows = sum(len(c) for c in method(data, schema, options,
+                                               args.chunksize))
+            total[method.__name__] = (total.get(method.__name__, 0) +
+                                      time.perf_counter() - start)
+        total['rows'] += rows
+
+    print('{0:9s} {1:>9s} {2:>13s} {3:>9s} {4:>8s}'.format(
+        'dataset', 'method', 'rows/s', 'MB/s', 'seconds'))
+    for ad, total in totals.items():
+        for method in ['inferred', 'compiled']:
+            seconds = total[method]
+            print('{0:9s} {1:>9s} {2:13,.0f} {3:9.1f} {4:8.2f}'.format(
+                ad, method, total['rows'] / seconds,
+                total['bytes'] / 2**20 / seconds, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,17 +14,67 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import sys
+import bz2
+import gzip
+import json
+import sqlite3
+import hashlib
+import pickle
+import shutil
+import tempfile
+import time
+import itertools
 import argparse
+import threading
+import queue
+import operator
+import importlib.util
 from pathlib import Path
-from distutils.util import strtobool as stb
-import pandas as pd
+from functools import partial
+from contextlib import contextmanager, nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+try:
+    import fcntl
+except ImportError:            # not on Windows
+    fcntl = None
+try:
+    import resource
+except ImportError:            # not on Windows
+    resource = None
 from zipfile import ZipFile as zf
-import requests as r
 import re
 
+
+def lazy_import(name):
+    """Import module name, but only load it once an attribute is used.
+
+    pandas, numpy and requests take far longer to load than the rest of
+    fd, and commands such as available and help never need them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+r = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
+
+
 # globals/decorators
 actions = {}
+args = argparse.Namespace(quiet=False)  # replaced by parsed options in main()
 
 def action(fn):
     global actions
@@ -45,20 +95,21 @@ bls = {
 }
 
 
-def get_bls_dtypes(bls_dict):
-    """Get dtypes from dictionary that defines bls:dataset of interest."""
-    # TODO 2016-12-28 moving to util: get_dtypes... deprecated?
-    items = bls_dict['dtype'].items()
-    ints = [k for k, v in items if v == int]
-    flts = [k for k, v in items if v == float]
-    strs = [k for k, v in items if v == str]
-    return [ints, flts, strs, ]
-
-
 # agency: bls cew
 bls_cew = {
     'webpage': 'cew/datatoc.htm',
     'docs': 'cew/doctoc.htm',
+    'partition': 'year',
+    'indexes': ['area_fips', 'industry_code'],
+    'rollups': {
+        # each aggregation level covers the same jobs again, so no rollup
+        # may sum across levels
+        'by': ['agglvl_code'],
+        'measures': ['qtrly_estabs_count', 'month1_emplvl', 'month2_emplvl',
+                     'month3_emplvl', 'total_qtrly_wages',
+                     'taxable_qtrly_wages', 'qtrly_contributions'],
+    },
+    'rename': {'oty_taxable_qtrly_wages_chg.1': 'oty_taxable_qtrly_wages_pct', },
     'rgxs': [
         (r'(?P<url>cew/data/files/[0-9]{4}/csv/'
          r'(?P<year>[0-9]{4})_qtrly_naics10_totals.zip)'),
@@ -67,18 +118,18 @@ bls_cew = {
     ],
     'dtype': {
         'area_fips': str,
-        'own_code': str,
+        'own_code': 'category',
         'industry_code': str,
-        'agglvl_code': str,
-        'size_code': str,
+        'agglvl_code': 'category',
+        'size_code': 'category',
         'year': str,
         'qtr': float,
-        'disclosure_code': str,
-        'area_title': str,
-        'own_title': str,
-        'industry_title': str,
-        'agglvl_title': str,
-        'size_title': str,
+        'disclosure_code': 'category',
+        'area_title': 'category',
+        'own_title': 'category',
+        'industry_title': 'category',
+        'agglvl_title': 'category',
+        'size_title': 'category',
         'qtrly_estabs_count': float,
         'month1_emplvl': float,
         'month2_emplvl': float,
@@ -87,7 +138,7 @@ bls_cew = {
         'taxable_qtrly_wages': float,
         'qtrly_contributions': float,
         'avg_wkly_wage': float,
-        'lq_disclosure_code': str,
+        'lq_disclosure_code': 'category',
         'lq_qtrly_estabs_count': float,
         'lq_month1_emplvl': float,
         'lq_month2_emplvl': float,
@@ -96,7 +147,7 @@ bls_cew = {
         'lq_taxable_qtrly_wages': float,
         'lq_qtrly_contributions': float,
         'lq_avg_wkly_wage': float,
-        'oty_disclosure_code': str,
+        'oty_disclosure_code': 'category',
         'oty_qtrly_estabs_count_chg': float,
         'oty_qtrly_estabs_count_pct_chg': float,
         'oty_month1_emplvl_chg': float,
@@ -118,8 +169,15 @@ bls_cew = {
 
 
 def get_bls_cew_urls():
-    """Yield full BLS CEW URLs to download."""
-    html = r.get(bls['base'] + bls_cew['webpage']).text
+    """Full BLS CEW URLs to download, from the catalog."""
+    return catalog_urls('bls:cew', resolve_bls_cew_urls)
+
+
+def resolve_bls_cew_urls():
+    """Yield full BLS CEW URLs to download, scanned from the CEW webpage."""
+    req = r.get(bls['base'] + bls_cew['webpage'], timeout=60)
+    req.raise_for_status()
+    html = req.text
     for rgx in bls_cew['rgxs']:
         for url_match in re.finditer(rgx, html):
             yield bls['base']+url_match.group('url')
@@ -140,59 +198,176 @@ def bls_cew_download(fdDir):
     """Download BLS CEW data."""
     d = check_directory_download(fdDir.joinpath('bls/cew'))
     qprint("bls:cew -> {0}".format(d))
-    for url in get_bls_cew_urls():
-        copy_url(url, d)
+    download_urls(get_bls_cew_urls(), d)
     qprint("bls:cew data downloaded\x1b[K.")
 
 
+@action
+def bls_cew_update(fdDir):
+    """Re-download changed BLS CEW data."""
+    d = check_directory_update(Path(fdDir, 'bls/cew'))
+    qprint("bls:cew -> {0}".format(d))
+    changed = download_urls(get_bls_cew_urls(), d, update=True)
+    qprint("bls:cew: {0} changed file(s) downloaded\x1b[K.".format(len(changed)))
+
+
+@action
+def bls_cew_fetch(fdDir):
+    """Download and consolidate BLS CEW data, each archive as it arrives."""
+    d = check_directory_download(fdDir.joinpath('bls/cew'))
+    qprint("bls:cew -> {0}".format(d))
+    urls = list(get_bls_cew_urls())
+    names = sorted(url.split('/')[-1] for url in urls)
+    sources = {name: [d / name] for name in names}
+    fips = option('fips') and load_fips(option('fips'))
+    settings = {'fips': sorted(fips)} if fips else {}
+    rollups = rollup_specs(bls_cew)
+    if rollups:
+        settings['rollups'] = sorted(rollups)
+    with consolidate_output(d, bls_cew, sources, rebuild=True,
+                            settings=settings) as (stale, write), \
+            rollup_output(d, bls_cew, rollups, sources, stale) as add:
+        archives = fetch_urls(urls, d)
+        for z, chunks in bls_cew_archives(archives, option('jobs', 1), fips):
+            for chunk in chunks:
+                write(chunk, z.name)
+                add(chunk, z.name)
+    qprint("bls:cew data fetched and consolidated\x1b[K.")
+
+
+@action
+def bls_cew_query(fdDir):
+    """Query consolidated BLS CEW data."""
+    query(check_directory_consolidate(Path(fdDir, 'bls/cew')), bls_cew)
+
+
 @action
 def bls_cew_consolidate(fdDir):
     """Consolidate downloaded BLS CEW data."""
     d = check_directory_consolidate(fdDir.joinpath('bls/cew'))
-    zips = d.glob('*.zip')
-    csvfile = d / 'data.csv'
-    dtypes = get_bls_dtypes(bls_cew)
-    header = True                 # write header only once
+    sources = {z.name: [z] for z in sorted(d.glob('*.zip'))}
+    fips = option('fips') and load_fips(option('fips'))
+    settings = {'fips': sorted(fips)} if fips else {}
+    rollups = rollup_specs(bls_cew)
+    if rollups:
+        settings['rollups'] = sorted(rollups)
+    with consolidate_output(d, bls_cew, sources,
+                            settings=settings) as (stale, write), \
+            rollup_output(d, bls_cew, rollups, sources, stale) as add:
+        archives = [d / name for name in stale]
+        for z, chunks in bls_cew_archives(archives, option('jobs', 1), fips):
+            for chunk in chunks:
+                write(chunk, z.name)
+                add(chunk, z.name)
+    qprint("bls:cew data consolidated\x1b[K.")
 
-    with csvfile.open('a') as f:
-        for z in zips:
 
-            qprint('Consolidating {0}...'.format(str(z).split('/')[-1]),
-                   end="\r")
-
-            with zf(str(z), 'r') as zfile:
-                csvs = (csv for csv in zfile.namelist()
-                        if re.search(r'all industries.csv', csv))
-                for csv in csvs:
-                    for chunk in pd.read_csv(zfile.open(csv), chunksize=10000):
-                        if False:
-                            # TODO consolidate only fips rows of CSVs
-                            # TODO need have fips.csv on hand
-                            fips = pd.read_csv(fdDir + "fips.csv")
-                            chunk = chunk[chunk.area_fips.isin(fips.fips)]
-
-                        # fix incorrectly named column
-                        try:
-                            chunk.rename(
-                                columns={'oty_taxable_qtrly_wages_chg.1':
-                                         'oty_taxable_qtrly_wages_pct', },
-                                inplace=True)
-                        except KeyError:
-                            pass
-
-                        # make data types match across chunks
-                        chunk = convert_dtypes(chunk, dtypes)
-                        chunk.to_csv(f, header=header, index=False,
-                                     float_format='%.2f')
-                        header = False
+def bls_cew_chunks(d, jobs=1, fips=None):
+    """Yield chunks of the BLS CEW archives downloaded to directory d."""
+    for z, chunks in bls_cew_archives(sorted(d.glob('*.zip')), jobs, fips):
+        yield from chunks
 
-    qprint("bls:cew data consolidated\x1b[K.")
+
+def bls_cew_archives(zips, jobs=1, fips=None):
+    """Yield (archive, its chunks) for each BLS CEW archive in zips, in order.
+
+    With jobs > 1, archives are parsed in a pool of that many processes,
+    each spooling its chunks to a temporary file; archives are still
+    yielded in order, as they are serially.  zips may be any iterable,
+    such as archives still being downloaded.  With fips, a set from
+    load_fips, only the rows of those areas are kept.  --memory-limit is
+    shared between the workers and this process.
+    """
+    memory_limit = option('memory_limit')
+    if jobs <= 1:
+        for z in zips:
+            qprint('Consolidating {0}...'.format(z.name), end="\r")
+            yield z, bls_cew_archive_chunks(z, fips, memory_limit)
+        return
+    if memory_limit:
+        memory_limit //= jobs + 1
+    zips = iter(zips)
+    first = next(zips, None)
+    if first is None:
+        return
+
+    # multiprocessing is slow to import, and few commands need it
+    from concurrent.futures import ProcessPoolExecutor
+
+    spooldir = str(first.parent)
+    zips = itertools.chain([first], zips)
+    pending = deque()               # (archive, future spool path), in order
+    # workers mark the memory of their stages as this process does
+    track = track_memory if memory_tracked[0] else None
+    with tempfile.TemporaryDirectory(dir=spooldir) as spool, \
+            ProcessPoolExecutor(max_workers=jobs, initializer=track) as pool:
+        def submit(n):
+            for z in itertools.islice(zips, n):
+                path = Path(spool, z.name + '.pickle')
+                future = pool.submit(spool_chunks, bls_cew_archive_chunks,
+                                     z, path, fips, memory_limit)
+                pending.append((z, future))
+
+        submit(2 * jobs)            # bound the spooled archives on disk
+        while pending:
+            z, future = pending.popleft()
+            qprint('Consolidating {0}...'.format(z.name), end="\r")
+            path, worker_metrics = future.result()
+            merge_metrics(worker_metrics)
+            yield z, unspool_chunks(path)
+            submit(1)
+
+
+def bls_cew_archive_chunks(z, fips=None, memory_limit=None):
+    """Yield chunks of the all industries CSVs in BLS CEW archive z,
+    keeping only the rows of the areas in fips, if given, and sized to
+    memory_limit, as read_chunks does.
+    """
+    dtypes = get_dtypes(bls_cew)
+    args = read_args(bls_cew)
+    with zf(str(z), 'r') as zfile:
+        csvs = (csv for csv in zfile.namelist()
+                if re.search(r'all industries.csv', csv))
+        for csv in csvs:
+            record_stage('parse', nbytes=zfile.getinfo(csv).file_size,
+                         calls=0)
+            reader = pd.read_csv(zfile.open(csv), iterator=True, **args)
+            for chunk in timed('parse', read_chunks(reader, memory_limit)):
+                if fips is not None:
+                    with stage('filter', rows=len(chunk)):
+                        chunk = chunk[chunk['area_fips'].isin(fips)]
+
+                # fix incorrectly named column
+                chunk.rename(columns=bls_cew['rename'], inplace=True)
+
+                # narrow integers; the reader parsed everything else
+                with stage('convert', rows=len(chunk)):
+                    chunk = convert_dtypes(chunk, dtypes)
+                yield chunk
 
 
 # agency: bls ce
 bls_ce = {
     'webpage': 'ce/',
     'docs': 'ce.txt',
+    'partition': 'year',
+    'indexes': ['series_id'],
+    'matrix': {'rows': 'series_id', 'columns': ['year', 'period'],
+               'value': 'value'},
+    'dimensions': [
+        ('datatype', 'data_type_code', ['data_type_text']),
+        ('industry', 'industry_code',
+         ['naics_code', 'publishing_status', 'industry_name', 'display_level',
+          'selectable', 'sort_sequence']),
+        ('seasonal', 'seasonal', ['season_text']),
+        ('supersector', 'supersector_code', ['supersector_name']),
+        ('series', 'series_id',
+         ['supersector_code', 'industry_code', 'data_type_code', 'seasonal',
+          'footnote_code_series', 'begin_year', 'begin_period', 'end_year',
+          'end_period', 'series_title']),
+        ('period', 'period', ['period_abbr', 'period_name']),
+    ],
+    'na_values': {'value': ['-', ], },
     'data_urls': [
         'ce.data.0.AllCESSeries',
         'ce.datatype',
@@ -203,29 +378,28 @@ bls_ce = {
         'ce.supersector',
     ],
     'dtype': {
-        'data_type_text': str,
-        'industry_name': str,
-        'period_name': str,
+        'data_type_text': 'category',
+        'industry_name': 'category',
+        'period_name': 'category',
         'series_title': str,
-        'supersector_name': str,
+        'supersector_name': 'category',
         'series_id': str,
         'industry_code': str,
         'naics_code': str,
-        'period': str,
-        'footnote_codes': str,
+        'period': 'category',
+        'footnote_codes': 'category',
         'sort_sequence': str,
-        'publishing_status': str,
-        'supersector_code': str,
-        'data_type_code': str,
-        'seasonal': str,
-        'footnote_code_series': str,
-        'begin_period': str,
-        'end_period': str,
-        'display_level': str,
-        'selectable': str,
-        'season_text': str,
-        'supersector_name': str,
-        'period_abbr': str,
+        'publishing_status': 'category',
+        'supersector_code': 'category',
+        'data_type_code': 'category',
+        'seasonal': 'category',
+        'footnote_code_series': 'category',
+        'begin_period': 'category',
+        'end_period': 'category',
+        'display_level': 'category',
+        'selectable': 'category',
+        'season_text': 'category',
+        'period_abbr': 'category',
         'year': int,
         'value': float,
         'begin_year': int,
@@ -235,6 +409,11 @@ bls_ce = {
 
 
 def get_bls_ce_urls():
+    """Full BLS CE URLs to download, from the catalog."""
+    return catalog_urls('bls:ce', resolve_bls_ce_urls)
+
+
+def resolve_bls_ce_urls():
     """Yield full BLS CE URLs to download."""
     for url in bls_ce['data_urls']:
         yield bls['time_series'] + bls_ce['webpage'] + url
@@ -256,18 +435,81 @@ def bls_ce_download(fdDir):
     """Download BLS CE data."""
     d = check_directory_download(Path(fdDir, 'bls/ce'))
     qprint("bls:ce -> {0}".format(d))
-    for url in get_bls_ce_urls():
-        copy_url(url, d)
+    download_urls(get_bls_ce_urls(), d)
     qprint("bls:ce data downloaded\x1b[K.")
 
 
+@action
+def bls_ce_update(fdDir):
+    """Re-download changed BLS CE data."""
+    d = check_directory_update(Path(fdDir, 'bls/ce'))
+    qprint("bls:ce -> {0}".format(d))
+    changed = download_urls(get_bls_ce_urls(), d, update=True)
+    qprint("bls:ce: {0} changed file(s) downloaded\x1b[K.".format(len(changed)))
+
+
+@action
+def bls_ce_fetch(fdDir):
+    """Download and consolidate BLS CE data, parsing it as it streams in."""
+    d = check_directory_download(Path(fdDir, 'bls/ce'))
+    qprint("bls:ce -> {0}".format(d))
+    data, *tables = get_bls_ce_urls()
+    download_urls(tables, d)
+    sources = {'ce.data.0.AllCESSeries': [d/f for f in bls_ce['data_urls']]}
+    with consolidate_output(d, bls_ce, sources, rebuild=True) as (_, write), \
+            stream_url(data, d) as stream:
+        for chunk in bls_ce_chunks(d, stream):
+            write(chunk, 'ce.data.0.AllCESSeries')
+    qprint("bls:ce data fetched and consolidated\x1b[K.")
+
+
+@action
+def bls_ce_query(fdDir):
+    """Query consolidated BLS CE data."""
+    query(check_directory_consolidate(Path(fdDir, 'bls/ce')), bls_ce)
+
+
 @action
 def bls_ce_consolidate(fdDir):
     """Consolidate downloaded BLS CE data."""
     d = check_directory_consolidate(fdDir.joinpath('bls/ce'))
     qprint('Consolidating {0}...'.format(d), end="\r")
+    sources = {'ce.data.0.AllCESSeries': [d/f for f in bls_ce['data_urls']]}
+    with consolidate_output(d, bls_ce, sources) as (stale, write):
+        for source in stale:
+            for chunk in bls_ce_chunks(d):
+                write(chunk, source)
+    qprint('bls:ce data consolidated\x1b[K.')
+
+
+def bls_ce_chunks(d, data=None):
+    """Yield chunks of the BLS CE data downloaded to directory d.
+
+    data is the file, or readable stream, of all the data; by default
+    d/ce.data.0.AllCESSeries.
+    """
+    with stage('dimensions'):
+        series = index_dimension(bls_ce_series(d), 'series_id')
+        period = index_dimension(bls_ce_period(d), 'period')
+
+    # attach series and period to All in chunks
+    dtypes = get_dtypes(bls_ce)
+    args = read_args(bls_ce)
+    if data is None:
+        data = d/'ce.data.0.AllCESSeries'
+        record_stage('parse', nbytes=data.stat().st_size, calls=0)
+    reader = pd.read_table(data, iterator=True, **args)
+    for chunk in timed('parse', read_chunks(reader, option('memory_limit'))):
+        with stage('join', rows=len(chunk)):
+            chunk = attach_dimension(chunk, series)
+            chunk = attach_dimension(chunk, period)
+        with stage('convert', rows=len(chunk)):
+            chunk = convert_dtypes(chunk, dtypes)
+        yield chunk
 
-    # merge to series
+
+def bls_ce_series(d):
+    """Read BLS CE's series table merged with its code tables."""
     series = pd.read_table(
         d/'ce.series',
         dtype={
@@ -333,33 +575,39 @@ def bls_ce_consolidate(fdDir):
     )
     series = pd.merge(series, sector, how='left', on='supersector_code')
     del sector
+    return series
+
 
-    period = pd.read_table(
+def bls_ce_period(d):
+    """Read BLS CE's period table."""
+    return pd.read_table(
         d/'ce.period',
         header=None,
         names=['period', 'period_abbr', 'period_name', ]
     )
 
-    # merge series and period to All in chunks then write
-    csvfile = d/'data.csv'
-    header = True                   # only write headers once
-    dtypes = get_bls_dtypes(bls_ce)
-    with csvfile.open('a') as f:
-        for chunk in pd.read_table(d/'ce.data.0.AllCESSeries',
-                                   chunksize=10000):
-            chunk = pd.merge(chunk, series, how='left', on='series_id')
-            chunk = pd.merge(chunk, period, how='left', on='period')
-            chunk = convert_dtypes(chunk, dtypes)
-            chunk.to_csv(f, header=header, index=False, float_format='%.2f')
-            header = False
-
-    qprint('bls:ce data consolidated\x1b[K.')
-
 
 # agency: bls sm
 bls_sm = {
     'webpage': 'sm/',
     'docs': 'sm.txt',
+    'partition': 'year',
+    'indexes': ['series_id'],
+    'matrix': {'rows': 'series_id', 'columns': ['year', 'period'],
+               'value': 'value'},
+    'dimensions': [
+        ('area', 'area_code', ['area_name']),
+        ('state', 'state_code', ['state_name']),
+        ('supersector', 'supersector_code', ['supersector_name']),
+        ('datatype', 'data_type_code', ['data_type_text']),
+        ('industry', 'industry_code', ['industry_name']),
+        ('series', 'series_id',
+         ['state_code', 'area_code', 'supersector_code', 'industry_code',
+          'data_type_code', 'seasonal', 'footnote_code_series',
+          'benchmark_year', 'begin_year', 'begin_period', 'end_year',
+          'end_period']),
+    ],
+    'na_values': {'value': ['-', ], },
     'data_urls': [
         'sm.data.1.AllData',
         'sm.area',
@@ -371,21 +619,21 @@ bls_sm = {
     ],
     'dtype': {
         'area_code': str,
-        'area_name': str,
+        'area_name': 'category',
         'benchmark_year': int,
-        'state_code': str,
-        'state_name': str,
-        'data_type_text': str,
-        'industry_name': str,
+        'state_code': 'category',
+        'state_name': 'category',
+        'data_type_text': 'category',
+        'industry_name': 'category',
         'series_id': str,
-        'supersector_code': str,
+        'supersector_code': 'category',
         'industry_code': str,
-        'period': str,
-        'footnote_codes': str,
-        'data_type_code': str,
-        'seasonal': str,
-        'begin_period': str,
-        'end_period': str,
+        'period': 'category',
+        'footnote_codes': 'category',
+        'data_type_code': 'category',
+        'seasonal': 'category',
+        'begin_period': 'category',
+        'end_period': 'category',
         'year': int,
         'value': float,
         'begin_year': int,
@@ -395,6 +643,11 @@ bls_sm = {
 
 
 def get_bls_sm_urls():
+    """Full BLS SM URLs to download, from the catalog."""
+    return catalog_urls('bls:sm', resolve_bls_sm_urls)
+
+
+def resolve_bls_sm_urls():
     """Yield full BLS SM URLs to download."""
     for url in bls_sm['data_urls']:
         yield bls['time_series'] + bls_sm['webpage'] + url
@@ -416,18 +669,79 @@ def bls_sm_download(fdDir):
     """Download BLS SM data."""
     d = check_directory_download(Path(fdDir, 'bls/sm'))
     qprint("bls:sm -> {0}".format(d))
-    for url in get_bls_sm_urls():
-        copy_url(url, d)
+    download_urls(get_bls_sm_urls(), d)
     qprint("bls:sm data downloaded\x1b[K.")
 
 
+@action
+def bls_sm_update(fdDir):
+    """Re-download changed BLS SM data."""
+    d = check_directory_update(Path(fdDir, 'bls/sm'))
+    qprint("bls:sm -> {0}".format(d))
+    changed = download_urls(get_bls_sm_urls(), d, update=True)
+    qprint("bls:sm: {0} changed file(s) downloaded\x1b[K.".format(len(changed)))
+
+
+@action
+def bls_sm_fetch(fdDir):
+    """Download and consolidate BLS SM data, parsing it as it streams in."""
+    d = check_directory_download(Path(fdDir, 'bls/sm'))
+    qprint("bls:sm -> {0}".format(d))
+    data, *tables = get_bls_sm_urls()
+    download_urls(tables, d)
+    sources = {'sm.data.1.AllData': [d/f for f in bls_sm['data_urls']]}
+    with consolidate_output(d, bls_sm, sources, rebuild=True) as (_, write), \
+            stream_url(data, d) as stream:
+        for chunk in bls_sm_chunks(d, stream):
+            write(chunk, 'sm.data.1.AllData')
+    qprint("bls:sm data fetched and consolidated\x1b[K.")
+
+
+@action
+def bls_sm_query(fdDir):
+    """Query consolidated BLS SM data."""
+    query(check_directory_consolidate(Path(fdDir, 'bls/sm')), bls_sm)
+
+
 @action
 def bls_sm_consolidate(fdDir):
     """Consolidate downloaded BLS SM data."""
     d = check_directory_consolidate(fdDir.joinpath('bls/sm'))
     qprint('Consolidating {0}...'.format(d), end='\r')
+    sources = {'sm.data.1.AllData': [d/f for f in bls_sm['data_urls']]}
+    with consolidate_output(d, bls_sm, sources) as (stale, write):
+        for source in stale:
+            for chunk in bls_sm_chunks(d):
+                write(chunk, source)
+    qprint("bls:sm data consolidated\x1b[K.")
+
 
-    # merge to series
+def bls_sm_chunks(d, data=None):
+    """Yield chunks of the BLS SM data downloaded to directory d.
+
+    data is the file, or readable stream, of all the data; by default
+    d/sm.data.1.AllData.
+    """
+    with stage('dimensions'):
+        series = index_dimension(bls_sm_series(d), 'series_id')
+
+    # attach series to All in chunks
+    dtypes = get_dtypes(bls_sm)
+    args = read_args(bls_sm)
+    if data is None:
+        data = d/'sm.data.1.AllData'
+        record_stage('parse', nbytes=data.stat().st_size, calls=0)
+    reader = pd.read_table(data, iterator=True, **args)
+    for chunk in timed('parse', read_chunks(reader, option('memory_limit'))):
+        with stage('join', rows=len(chunk)):
+            chunk = attach_dimension(chunk, series)
+        with stage('convert', rows=len(chunk)):
+            chunk = convert_dtypes(chunk, dtypes)
+        yield chunk
+
+
+def bls_sm_series(d):
+    """Read BLS SM's series table merged with its code tables."""
     series = pd.read_table(
         d/'sm.series',
         dtype={
@@ -486,21 +800,7 @@ def bls_sm_consolidate(fdDir):
     )
     series = pd.merge(series, state, how='left', on='state_code')
     del state
-
-    # merge series and All in chunks then write
-    csvfile = d/'data.csv'
-    header = True
-    dtypes = get_bls_dtypes(bls_sm)
-    with csvfile.open('a') as f:
-        for chunk in pd.read_table(d/'sm.data.1.AllData',
-                                   chunksize=10000):
-            chunk = pd.merge(chunk, series, how='left', on='series_id')
-            chunk.value = pd.to_numeric(chunk.value, errors='coerce')
-            chunk = convert_dtypes(chunk, dtypes)
-            chunk.to_csv(f, header=header, index=False, float_format='%.2f')
-            header = False
-
-    qprint("bls:sm data consolidated\x1b[K.")
+    return series
 
 
 # agency: epa
@@ -519,34 +819,42 @@ epa_ucmr = {
         '2015-09/ucmr2_occurrencedata_jan12.zip',
     ],
     'docs': 'sites/production/files/2016-05/documents/ucmr3-data-summary-april-2016.pdf',
+    'partition': 'CollectionDate',
+    'indexes': ['PWSID'],
     'dtype': {
         'ZIPCODE': str,
         'PWSID': str,
         'PWSName': str,
-        'Size': str,
+        'Size': 'category',
         'FacilityID': str,
         'FacilityName': str,
-        'FacilityWaterType': str,
+        'FacilityWaterType': 'category',
         'SamplePointID': str,
         'SamplePointName': str,
-        'SamplePointType': str,
+        'SamplePointType': 'category',
         'AssociatedFacilityID': str,
         'AssociatedSamplePointID': str,
         'CollectionDate': str,
         'SampleID': str,
-        'Contaminant': str,
+        'Contaminant': 'category',
         'MRL': float,
-        'MethodID': str,
-        'AnalyticalResultsSign': str,
-        'AnalyticalResultsValue': float,
-        'SampleEventCode': str,
-        'MonitoringRequirement': str,
-        'Region': str,
-        'State': str,
+        'MethodID': 'category',
+        'AnalyticalResultsSign': 'category',
+        'AnalyticalResultValue': float,
+        'SampleEventCode': 'category',
+        'MonitoringRequirement': 'category',
+        'Region': 'category',
+        'State': 'category',
+        'DisinfectantType': 'category',
     },
 }
 
 def get_epa_ucmr_urls():
+    """Full EPA UCMR URLs to download, from the catalog."""
+    return catalog_urls('epa:ucmr', resolve_epa_ucmr_urls)
+
+
+def resolve_epa_ucmr_urls():
     """Yield full EPA UCMR URLs to dowload."""
     for url_piece in epa_ucmr['data_urls']:
         yield epa['base'] + 'sites/production/files/' + url_piece
@@ -557,74 +865,81 @@ def epa_ucmr_download(fdDir):
     """Download EPA UCMR data."""
     d = check_directory_download(Path(fdDir, 'epa/ucmr'))
     qprint("epa:ucmr -> {0}".format(d))
-    for url in get_epa_ucmr_urls():
-        copy_url(url, d)
+    download_urls(get_epa_ucmr_urls(), d)
     qprint("epa:ucmr data downloaded\x1b[K.")
 
 
+@action
+def epa_ucmr_update(fdDir):
+    """Re-download changed EPA UCMR data."""
+    d = check_directory_update(Path(fdDir, 'epa/ucmr'))
+    qprint("epa:ucmr -> {0}".format(d))
+    changed = download_urls(get_epa_ucmr_urls(), d, update=True)
+    qprint("epa:ucmr: {0} changed file(s) downloaded\x1b[K.".format(len(changed)))
+
+
+@action
+def epa_ucmr_fetch(fdDir):
+    """Download and consolidate EPA UCMR data.
+
+    Each occurrence file is joined to tables inside the other archive, so
+    consolidation waits for both downloads rather than overlapping them.
+    """
+    d = check_directory_download(Path(fdDir, 'epa/ucmr'))
+    qprint("epa:ucmr -> {0}".format(d))
+    download_urls(get_epa_ucmr_urls(), d)
+    sources = {'ucmr': [d/url.split('/')[-1] for url in epa_ucmr['data_urls']]}
+    with consolidate_output(d, epa_ucmr, sources, rebuild=True) as (_, write):
+        for chunk in epa_ucmr_chunks(d):
+            write(chunk, 'ucmr')
+    qprint('epa:ucmr data fetched and consolidated\x1b[K.')
+
+
+@action
+def epa_ucmr_query(fdDir):
+    """Query consolidated EPA UCMR data."""
+    query(check_directory_consolidate(Path(fdDir, 'epa/ucmr')), epa_ucmr)
+
+
 @action
 def epa_ucmr_consolidate(fdDir):
     """Conslidate EPA UCMR data."""
-    # TODO double check this function; use less memory
-    # < memory: merge other data, read/write/merge/append all3/all2 in chunks?
-
     d = check_directory_consolidate(fdDir.joinpath('epa/ucmr'))
     qprint('Consolidating {0}...'.format(d), end="\r")
+    sources = {'ucmr': [d/url.split('/')[-1] for url in epa_ucmr['data_urls']]}
+    with consolidate_output(d, epa_ucmr, sources) as (stale, write):
+        for source in stale:
+            for chunk in epa_ucmr_chunks(d):
+                write(chunk, source)
+    qprint('epa:ucmr data consolidated\x1b[K.')
 
-    with zf(str(d/'ucmr-3-occurrence-data.zip'), 'r') as zfile3, zf(str(d/'ucmr2_occurrencedata_jan12.zip'), 'r') as zfile2:
-        all3 = pd.read_table(
-            zfile3.open('UCMR3_All.txt'),
-            encoding='latin1',
-            dtype={
-                'PWSID': str,
-                'PWSName': str,
-                'Size': str,
-                'FacilityID': str,
-                'FacilityName': str,
-                'FacilityWaterType': str,
-                'SamplePointID': str,
-                'SamplePointName': str,
-                'SamplePointType': str,
-                'AssociatedFacilityID': str,
-                'AssociatedSamplePointID': str,
-                'CollectionDate': str,
-                'SampleID': str,
-                'Contaminant': str,
-                'MRL': float,
-                'MethodID': str,
-                'AnalyticalResultsSign': str,
-                'AnalyticalResultValue': float,
-                'SampleEventCode': str,
-                'MonitoringRequirement': str,
-                'Region': str,
-                'State': str,
-            }
-        )
 
+def epa_ucmr_chunks(d):
+    """Yield chunks of the EPA UCMR data downloaded to directory d.
+
+    Both occurrence files are streamed in chunks.  The DRT and zip code
+    tables are small, so they are read once, indexed on their join keys
+    and joined to each chunk.  Every chunk carries the same columns: the
+    union of both occurrence files' columns plus the joined ones.
+    """
+    with zf(str(d/'ucmr-3-occurrence-data.zip'), 'r') as zfile3, zf(str(d/'ucmr2_occurrencedata_jan12.zip'), 'r') as zfile2:
+        drt_keys = ['PWSID', 'FacilityID', 'SamplePointID', 'CollectionDate', ]
         drt = pd.read_table(
             zfile3.open('UCMR3_DRT.txt'),
             encoding='latin1',
+            usecols=drt_keys + ['Disinfectant Type', ],
             dtype={
                 'PWSID': str,
                 'FacilityID': str,
                 'SamplePointID': str,
-                'SampleEventCode': str,
                 'CollectionDate': str,
                 'Disinfectant Type': str,
             }
         )
-
-        all3 = pd.merge(
-            all3, drt,
-            how='left',
-            on=[
-                'PWSID',
-                'FacilityID',
-                'SamplePointID',
-                'CollectionDate',
-            ]
-        )
-        del drt
+        # UCMR2 reports the same variable as DisinfectantType
+        drt.rename(columns={'Disinfectant Type': 'DisinfectantType', },
+                   inplace=True)
+        drt.set_index(drt_keys, inplace=True)
 
         zipcodes = pd.read_table(
             zfile3.open('UCMR3_ZipCodes.txt'),
@@ -633,50 +948,38 @@ def epa_ucmr_consolidate(fdDir):
                 'PWSID': str,
                 'ZIPCODE': str,
             })
-        all3 = pd.merge(all3, zipcodes, how='left', on='PWSID')
-
-
-        all2 = pd.read_table(
-            zfile2.open('UCMR2_All_OccurrenceData_Jan12.txt'),
-            encoding='latin1',
-            dtype={
-                'PWSID': str,
-                'PWSName': str,
-                'Size': str,
-                'FacilityID': str,
-                'FacilityName': str,
-                'FacilityWaterType': str,
-                'SamplePointID': str,
-                'SamplePointName': str,
-                'SamplePointType': str,
-                'AssociatedFacilityID': str,
-                'AssociatedSamplePointID': str,
-                'DisinfectantType': str,
-                'CollectionDate': str,
-                'SampleID': str,
-                'Contaminant': str,
-                'MRL': float,
-                'MethodID': str,
-                'AnalyticalResultsSign': str,
-                'AnalyticalResultValue': float,
-                'SampleEventCode': str,
-                'MonitoringRequirement': str,
-                'Region': str,
-                'State': str,
-            }
-        )
-
-        all2 = pd.merge(all2, zipcodes, how='left', on='PWSID')
-
-        all = all3.append(all2, ignore_index=True)
-        del all3, all2
-
-        csvfile = d / 'data.csv'
-        with csvfile.open('a') as f:
-            all.to_csv(f, index=False, float_format='%.2f')
-
-    qprint('epa:ucmr data consolidated\x1b[K.')
-
+        zipcodes.set_index('PWSID', inplace=True)
+
+        all3 = ('UCMR3_All.txt', zfile3)
+        all2 = ('UCMR2_All_OccurrenceData_Jan12.txt', zfile2)
+
+        # fix the columns up front, as chunks are written as they're read
+        columns = []
+        for name, zfile in [all3, all2]:
+            with zfile.open(name) as f:
+                header = f.readline().decode('latin1').rstrip('\r\n')
+            columns += [c for c in header.split('\t')
+                        if c in epa_ucmr['dtype'] and c not in columns]
+        columns += [c for c in drt.columns.tolist() + ['ZIPCODE']
+                    if c not in columns]
+
+        dtypes = get_dtypes(epa_ucmr)
+        args = read_args(epa_ucmr)
+        for name, zfile in [all3, all2]:
+            record_stage('parse', nbytes=zfile.getinfo(name).file_size,
+                         calls=0)
+            reader = pd.read_table(zfile.open(name), encoding='latin1',
+                                   iterator=True, **args)
+            chunks = read_chunks(reader, option('memory_limit'))
+            for chunk in timed('parse', chunks):
+                with stage('join', rows=len(chunk)):
+                    if name == 'UCMR3_All.txt':
+                        chunk = chunk.join(drt, on=drt_keys)
+                    chunk = chunk.join(zipcodes, on='PWSID')
+                    chunk = chunk.reindex(columns=columns)
+                with stage('convert', rows=len(chunk)):
+                    chunk = convert_dtypes(chunk, dtypes)
+                yield chunk
 
 
 @action
@@ -692,38 +995,977 @@ def epa_ucmr_detail(fdDir):
 
 
 # utilities
-def copy_url(url, directory):
-    """Copy url into directory."""
+sessions = {}                   # host -> (requests.Session, BoundedSemaphore)
+sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """Get the shared keep-alive session, and its concurrency cap, for url's host.
+
+    One session is kept per host so that connections are reused across
+    files; its connection pool and semaphore are both sized by --per-host.
+    """
+    host = urlsplit(url).netloc
+    with sessions_lock:
+        if host not in sessions:
+            n = option('per_host', 4)
+            session = r.Session()
+            adapter = r.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=n)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = (session, threading.BoundedSemaphore(n))
+        return sessions[host]
+
+
+retry_statuses = {429, 500, 502, 503, 504}
+
+
+class IncompleteDownload(Exception):
+    """Transfer ended early or failed with a retryable HTTP status."""
+
+
+def copy_url(url, directory, update=False):
+    """Copy url into directory.
+
+    The transfer is written to filename.part and renamed into place once
+    complete.  A dropped connection or a transient server error is retried
+    with exponential backoff, resuming from the end of the .part file with
+    an HTTP Range request; If-Range, from the validators saved when the
+    part was started, makes the server send the whole file instead if it
+    has changed since.
+
+    Each file's validators are recorded in the directory's manifest.  With
+    update, a file still matching its manifest entry is only re-fetched if
+    the server says it changed; None is returned when it did not.
+
+    Otherwise, with --cache, a copy of url in the cache is linked into
+    place if the server says it is unchanged, and whatever is downloaded
+    is added to the cache.
+    """
     d = Path(directory)
     filename = url.split('/')[-1]
     path = d / filename
-    qprint('Downloading {0}...\x1b[K'.format(filename), end="\r")
-
-    req = r.get(url, stream=True)
-    if req.status_code != r.codes.ok:
-        req.raise_for_status()
-    with path.open('wb+') as f:
-        for chunk in req.iter_content(chunk_size=1024):
-            if chunk:
+    part = d / (filename + '.part')
+    session, slots = get_session(url)
+    retries = option('retries', 5)
+
+    validators = {}
+    if update:
+        entry = read_manifest(d).get(filename, {})
+        if path.exists() and path.stat().st_size == entry.get('size'):
+            validators = entry
+    cached = None if validators else cache_lookup(url)
+    if cached:
+        validators = cached
+
+    with slots:
+        for attempt in range(retries + 1):
+            try:
+                with stage('download'):
+                    headers = fetch_part(session, url, part, validators)
+                    if headers is None and cached:
+                        if cache_restore(cached, path):
+                            record_manifest(d, filename, download_entry(
+                                url, cached, path))
+                            return path
+                        # the cached copy is damaged; fetch it whole
+                        headers = fetch_part(session, url, part)
+                if headers is None:
+                    return None
+                part.replace(path)
+                discard_part(part)
+                entry = download_entry(url, {
+                    'etag': headers.get('etag'),
+                    'last_modified': headers.get('last-modified'),
+                }, path)
+                record_manifest(d, filename, entry)
+                cache_store(path, entry)
+                return path
+            except (r.ConnectionError, r.Timeout,
+                    r.exceptions.ChunkedEncodingError, IncompleteDownload) as e:
+                if attempt == retries:
+                    raise
+                wait = option('backoff', 1.0) * 2**attempt
+                qprint('{0}: {1}; retrying in {2:.0f}s\x1b[K'.format(
+                    filename, e.__class__.__name__, wait))
+                time.sleep(wait)
+
+
+def download_entry(url, validators, path):
+    """Manifest entry of url, downloaded to path, with validators'
+    etag and last_modified.
+    """
+    return {
+        'url': url,
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified'),
+        'size': path.stat().st_size,
+    }
+
+
+def conditional_headers(validators):
+    """Request headers asking for a body only if it changed since
+    validators, an entry of a manifest, were recorded.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def fetch_part(session, url, part, validators=None):
+    """Fetch url into part, resuming after any bytes part already holds.
+
+    Return the response headers, or None if validators (an entry of the
+    manifest) show the file is unchanged.  The validators of the response
+    that started part are saved to part.json, and a resumed request only
+    continues part if the file still matches them; a part without them is
+    started over.
+    """
+    filename = part.name[:-len('.part')]
+    validators = validators or {}
+    done = part.stat().st_size if part.exists() else 0
+    if_range = done and resume_validator(part)
+    if done and not if_range:
+        # nothing tells whether part is of the file the server has now
+        discard_part(part)
+        done = 0
+    if done:
+        headers = {'Range': 'bytes={0}-'.format(done), 'If-Range': if_range}
+    else:
+        headers = conditional_headers(validators)
+
+    req = session.get(url, stream=True, headers=headers, timeout=60)
+    try:
+        if req.status_code == r.codes.not_modified:
+            return None
+        if req.status_code == 416 and done:
+            # Range starts at the end: part is already complete
+            total = req.headers.get('content-range', '').rpartition('/')[2]
+            if total == str(done):
+                return req.headers
+            discard_part(part)
+            raise IncompleteDownload('stale partial download')
+        if req.status_code in retry_statuses:
+            raise IncompleteDownload('HTTP {0}'.format(req.status_code))
+        if req.status_code not in (r.codes.ok, r.codes.partial_content):
+            req.raise_for_status()
+        if req.status_code == r.codes.ok:
+            # server ignored Range, or the file changed; start over
+            done = 0
+            with part_validators(part).open('w') as f:
+                json.dump({'etag': req.headers.get('etag'),
+                           'last_modified': req.headers.get('last-modified')},
+                          f)
+
+        expected = int(req.headers.get('content-length', -1))
+        progress_start(filename, done + max(expected, 0), done)
+        received = 0
+        with part.open('ab' if done else 'wb') as f:
+            for chunk in req.iter_content(chunk_size=option('buffer_size', 2**20)):
                 f.write(chunk)
+                received += len(chunk)
+                progress_update(filename, len(chunk))
+        record_stage('download', nbytes=received, calls=0)
+        if expected >= 0 and received != expected:
+            raise IncompleteDownload('received {0} of {1} bytes'.format(
+                received, expected))
+        return req.headers
+    finally:
+        req.close()
+        progress_done(filename)
+
+
+def part_validators(part):
+    """Path of the validators saved for the partial download part."""
+    return part.with_name(part.name + '.json')
+
+
+def resume_validator(part):
+    """If-Range value for resuming part: the strong ETag, else the
+    Last-Modified, of the response that started it; None if neither.
+    """
+    try:
+        with part_validators(part).open() as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    etag = saved.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return saved.get('last_modified')
+
+
+def discard_part(part):
+    """Delete the partial download part and its saved validators."""
+    for path in (part, part_validators(part)):
+        if path.exists():
+            path.unlink()
+
+
+def download_urls(urls, directory, update=False):
+    """Download urls into directory with a bounded pool of workers.
+
+    Return the paths of the files transferred; with update, files the
+    server reports unchanged are skipped.  Errors raised by any single
+    download are re-raised once the remaining downloads have finished.
+    """
+    urls = list(urls)
+    paths = []
+    workers = min(option('workers', 8), len(urls)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(copy_url, url, directory, update)
+                   for url in urls]
+        for future in as_completed(futures):
+            path = future.result()
+            if path is not None:
+                paths.append(path)
+    return paths
+
+
+def fetch_urls(urls, directory, depth=2):
+    """Download urls into directory, yielding each path as it completes.
+
+    Downloads run in a pool of workers as in download_urls, but finished
+    paths pass through a queue of at most depth of them: a worker with a
+    finished file waits for room rather than starting another download,
+    so transfers never run far ahead of the consumer.  An error raised by
+    any download is raised here.
+    """
+    urls = list(urls)
+    done = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def fetch(url):
+        try:
+            result = copy_url(url, directory), None
+        except Exception as e:
+            result = None, e
+        while not stop.is_set():
+            try:
+                done.put(result, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    workers = min(option('workers', 8), len(urls)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for url in urls:
+            pool.submit(fetch, url)
+        try:
+            for _ in urls:
+                path, error = done.get()
+                if error is not None:
+                    raise error
+                yield path
+        finally:
+            stop.set()
+            pool.shutdown(cancel_futures=True)
+
+
+@contextmanager
+def stream_url(url, directory):
+    """Open url to read its body while it downloads into directory.
+
+    Everything read is also written to filename.part, which is renamed
+    into place and recorded in the manifest once the body has been read
+    to its end.  Dropped connections are resumed as in copy_url, unseen
+    by the reader.  With --cache, an unchanged copy of url in the cache is
+    linked into place and read instead, and a new one is added to it.
+    """
+    d = Path(directory)
+    filename = url.split('/')[-1]
+    path = d / filename
+    part = d / (filename + '.part')
+    session, slots = get_session(url)
+    cached = cache_lookup(url)
+    if cached and not_modified(session, url, cached) and \
+            cache_restore(cached, path):
+        record_manifest(d, filename, download_entry(url, cached, path))
+        with path.open('rb') as f:
+            yield f
+        return
+    with slots, part.open('wb') as f:
+        stream = UrlStream(session, url, f)
+        try:
+            yield io.BufferedReader(stream, option('buffer_size', 2**20))
+            while stream.read(2**20):
+                pass                # whatever the reader left unread
+        finally:
+            stream.close()
+            progress_done(filename)
+    part.replace(path)
+    entry = download_entry(url, {
+        'etag': stream.headers.get('etag'),
+        'last_modified': stream.headers.get('last-modified'),
+    }, path)
+    record_manifest(d, filename, entry)
+    cache_store(path, entry)
+
+
+def not_modified(session, url, validators):
+    """Whether the server says url is unchanged since validators."""
+    with session.get(url, stream=True, timeout=60,
+                     headers=conditional_headers(validators)) as req:
+        return req.status_code == r.codes.not_modified
+
+
+class UrlStream(io.RawIOBase):
+    """Raw, read-only stream of url's body, copied to file part as it is read.
+
+    A dropped connection or transient server error is retried with
+    exponential backoff, resuming after the bytes already read with an
+    HTTP Range request.
+    """
+
+    def __init__(self, session, url, part):
+        self.session = session
+        self.url = url
+        self.part = part
+        self.filename = url.split('/')[-1]
+        self.response = None
+        self.headers = {}
+        self.received = 0
+        self.expected = -1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with stage('download') as counts:
+            counts['bytes'] = n = self.read_body(b)
+        return n
+
+    def read_body(self, b):
+        retries = option('retries', 5)
+        for attempt in range(retries + 1):
+            try:
+                if self.response is None:
+                    self.connect()
+                data = self.response.raw.read(len(b))
+                if not data and 0 <= self.received < self.expected:
+                    raise IncompleteDownload('received {0} of {1} bytes'.format(
+                        self.received, self.expected))
+                break
+            except (r.ConnectionError, r.Timeout, urllib3.exceptions.HTTPError,
+                    IncompleteDownload) as e:
+                self.disconnect()
+                if attempt == retries:
+                    raise
+                wait = option('backoff', 1.0) * 2**attempt
+                qprint('{0}: {1}; retrying in {2:.0f}s\x1b[K'.format(
+                    self.filename, e.__class__.__name__, wait))
+                time.sleep(wait)
+        n = len(data)
+        b[:n] = data
+        self.part.write(data)
+        self.received += n
+        progress_update(self.filename, n)
+        return n
+
+    def connect(self):
+        """Request the body from the first byte not yet read."""
+        # ranges count bytes as sent, so ask for them unencoded
+        headers = {'Accept-Encoding': 'identity'}
+        if self.received:
+            headers['Range'] = 'bytes={0}-'.format(self.received)
+            etag = self.headers.get('etag')
+            if_range = (etag if etag and not etag.startswith('W/') else
+                        self.headers.get('last-modified'))
+            if if_range:
+                headers['If-Range'] = if_range
+        self.response = self.session.get(self.url, stream=True,
+                                         headers=headers, timeout=60)
+        status = self.response.status_code
+        if status in retry_statuses:
+            raise IncompleteDownload('HTTP {0}'.format(status))
+        if status not in (r.codes.ok, r.codes.partial_content):
+            self.response.raise_for_status()
+        if not self.received:
+            self.headers = self.response.headers
+            self.expected = int(self.headers.get('content-length', -1))
+            progress_start(self.filename, max(self.expected, 0))
+        elif status == r.codes.ok:
+            # the bytes already read were of another version of the file
+            for k in ('etag', 'last-modified'):
+                if self.response.headers.get(k) != self.headers.get(k):
+                    raise IOError('{0} changed on the server while it was '
+                                  'read'.format(self.filename))
+            # server ignored Range: skip the bytes already read
+            skip = self.received
+            while skip:
+                block = self.response.raw.read(min(skip, 2**20))
+                if not block:
+                    raise IncompleteDownload('stream ended early')
+                skip -= len(block)
+
+    def disconnect(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def close(self):
+        self.disconnect()
+        super().close()
+
+
+manifest_name = '.fd-manifest.json'
+manifest_lock = threading.Lock()
+
+
+def read_manifest(directory, name=manifest_name):
+    """Read directory's manifest of downloaded files: filename -> validators.
+
+    name picks another manifest kept the same way, such as the catalog.
+    """
+    path = Path(directory) / name
+    with manifest_lock:
+        if not path.exists():
+            return {}
+        with path.open() as f:
+            return json.load(f)
+
+
+def record_manifest(directory, filename, entry, name=manifest_name):
+    """Record entry as filename's validators in directory's manifest; an
+    entry of None removes filename's.
+
+    The manifest is replaced whole, so concurrent readers, even in other
+    processes, see either the old or the new version.  Writers in other
+    processes can still lose each other's updates; those sharing a
+    manifest, as the download cache's index is, hold a lock around each.
+    """
+    path = Path(directory) / name
+    with manifest_lock:
+        manifest = {}
+        if path.exists():
+            with path.open() as f:
+                manifest = json.load(f)
+        if entry is None:
+            manifest.pop(filename, None)
+        else:
+            manifest[filename] = entry
+        with tempfile.NamedTemporaryFile('w', dir=str(path.parent),
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        Path(f.name).replace(path)
+
+
+catalog_name = 'catalog.json'
+
+
+def catalog_urls(ad, resolve):
+    """Get the file URLs of dataset ad from the catalog under --directory.
+
+    Entries older than --catalog-ttl hours, or any with --refresh, are
+    resolved again with resolve() and recorded; should that fail, or find
+    no URLs, the old entry is used.  With --offline the catalog is used
+    whatever its age and nothing is fetched.
+    """
+    directory = Path(option('directory', Path.home() / 'fdata'))
+    entry = read_manifest(directory, catalog_name).get(ad)
+    if entry and not entry['urls']:
+        entry = None            # recorded by an fd that kept empty lists
+    if option('offline', False):
+        if entry is None:
+            msg = '{0} is not in the catalog in {1}; run once without --offline.'
+            report(msg.format(ad, directory))
+            sys.exit(1)
+        return entry['urls']
+
+    age = time.time() - entry['resolved'] if entry else None
+    if (entry and not option('refresh', False) and
+            age < option('catalog_ttl', 24.0) * 3600):
+        return entry['urls']
+    try:
+        urls = list(resolve())
+        if not urls:
+            raise LookupError('no URLs found')
+    except (r.RequestException, LookupError) as e:
+        if entry is not None:
+            qprint('{0}: {1}; using the catalog from {2:.0f}h ago\x1b[K'
+                   .format(ad, e, age / 3600))
+            return entry['urls']
+        if isinstance(e, LookupError):
+            report('{0}: found no files to download; try again later.'
+                   .format(ad))
+            sys.exit(1)
+        raise
+    if directory.is_dir():
+        record_manifest(directory, ad, {'urls': urls, 'resolved': time.time()},
+                        catalog_name)
+    return urls
+
+
+# download cache: objects/ holds each file once, named by its SHA-256, and
+# the index maps each URL to its object, validators and time last used
+cache_index_name = 'index.json'
+cache_lock_name = 'lock'
+cache_rlock = threading.RLock()
+cache_lock_depth = [0]          # cache_lock()s held by this process
+
+
+def cache_root():
+    """The cache directory, --cache, created if need be; None if unset."""
+    root = option('cache')
+    if root is None:
+        return None
+    root = Path(root)
+    (root / 'objects').mkdir(parents=True, exist_ok=True)
+    return root
+
+
+@contextmanager
+def cache_lock(root):
+    """Hold cache root's lock, shared by every fd process using it, while
+    its index or objects are read, then changed.
+
+    The lock is a flock on root/lock, where there is flock, and nests
+    within a process.
+    """
+    with cache_rlock:
+        if cache_lock_depth[0]:
+            cache_lock_depth[0] += 1
+            try:
+                yield
+            finally:
+                cache_lock_depth[0] -= 1
+            return
+        with (root / cache_lock_name).open('a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            cache_lock_depth[0] = 1
+            try:
+                yield
+            finally:
+                cache_lock_depth[0] = 0     # closing f releases the flock
+
+
+def cache_object(root, sha256):
+    """Path in cache root of the object whose SHA-256 is sha256."""
+    return root / 'objects' / sha256[:2] / sha256
+
+
+def cache_lookup(url):
+    """The cache's index entry for url, if it has one with validators."""
+    root = cache_root()
+    if root is None:
+        return None
+    entry = read_manifest(root, cache_index_name).get(url)
+    if entry and (entry.get('etag') or entry.get('last_modified')):
+        return entry
+    return None
+
+
+def cache_restore(entry, path):
+    """Link the cached object of index entry to path, if it is whole.
+
+    The object is hashed first: as it may be hardlinked into several
+    directories, a damaged one is dropped from the cache, and False
+    returned, rather than linked anywhere else.
+    """
+    root = cache_root()
+    obj = cache_object(root, entry['sha256'])
+    with cache_lock(root), stage('cache', nbytes=entry['size']):
+        if not obj.exists() or file_sha256(obj) != entry['sha256']:
+            qprint('{0}: cached copy damaged; dropping it\x1b[K'.format(
+                path.name))
+            if obj.exists():
+                obj.unlink()
+            record_manifest(root, entry['url'], None, cache_index_name)
+            return False
+        link_file(obj, path)
+        record_manifest(root, entry['url'], dict(entry, used=time.time()),
+                        cache_index_name)
+    return True
+
+
+def cache_store(path, entry):
+    """Add path, downloaded with manifest entry, to the cache, if any, then
+    evict the least recently used objects beyond --cache-size.
+    """
+    root = cache_root()
+    if root is None:
+        return
+    with stage('cache', nbytes=entry['size']):
+        sha256 = file_sha256(path)
+    obj = cache_object(root, sha256)
+    with cache_lock(root):
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True)
+            link_file(path, obj)
+        previous = cache_lookup(entry['url'])
+        record_manifest(root, entry['url'],
+                        dict(entry, sha256=sha256, used=time.time()),
+                        cache_index_name)
+        if previous and previous['sha256'] != sha256:
+            # drop the object url changed from, unless another url has it
+            index = read_manifest(root, cache_index_name)
+            old = cache_object(root, previous['sha256'])
+            if old.exists() and all(e['sha256'] != previous['sha256']
+                                    for e in index.values()):
+                old.unlink()
+        cache_evict(root, option('cache_size', parse_size('20G')))
+
+
+def cache_evict(root, limit):
+    """Drop the least recently used objects of cache root until it holds
+    at most limit bytes; return the URLs dropped.
+
+    Files under objects/ that no index entry names, left by a process
+    that stopped partway, count as last used when they were written.
+    Directories the objects are hardlinked into keep their copies.
+    """
+    with cache_lock(root):
+        objects = {}            # object -> [time last used, size, urls]
+        for url, entry in read_manifest(root, cache_index_name).items():
+            obj = cache_object(root, entry['sha256'])
+            o = objects.setdefault(obj, [0, entry['size'], []])
+            o[0] = max(o[0], entry['used'])
+            o[2].append(url)
+        for obj in (root / 'objects').glob('*/*'):
+            if obj not in objects:
+                stat = obj.stat()
+                objects[obj] = [stat.st_mtime, stat.st_size, []]
+        total = sum(size for _, size, _ in objects.values())
+        dropped = []
+        for obj, (_, size, urls) in sorted(objects.items(),
+                                           key=lambda kv: kv[1][0]):
+            if total <= limit:
+                break
+            if obj.exists():
+                obj.unlink()
+            for url in urls:
+                record_manifest(root, url, None, cache_index_name)
+            dropped += urls
+            total -= size
+        return dropped
+
+
+def link_file(src, dst):
+    """Hardlink src to dst, replacing dst; copy it where links can't go,
+    such as across filesystems.
+    """
+    tmp = dst.with_name(dst.name + '.link')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(str(src), str(tmp))
+    except OSError:
+        shutil.copyfile(str(src), str(tmp))
+    tmp.replace(dst)
+
+
+def cache(args):
+    """Print the contents of the download cache; prune or clear it."""
+    root = cache_root()
+    if root is None:
+        report('No download cache; set one with --cache DIR or FD_CACHE.')
+        sys.exit(1)
+    if args.clear or args.prune:
+        limit = 0 if args.clear else option('cache_size', parse_size('20G'))
+        dropped = cache_evict(root, limit)
+        print('Dropped {0} files from {1}.'.format(len(dropped), root))
+
+    index = read_manifest(root, cache_index_name)
+    sizes = {e['sha256']: e['size'] for e in index.values()}
+    print('{0}: {1} files, {2:.1f} of {3:.1f} MB'.format(
+        root, len(sizes), sum(sizes.values()) / 2**20,
+        option('cache_size', parse_size('20G')) / 2**20))
+    for url, entry in sorted(index.items(), key=lambda kv: -kv[1]['used']):
+        obj = cache_object(root, entry['sha256'])
+        links = obj.stat().st_nlink - 1 if obj.exists() else 0
+        print('  {0:10.1f} MB  {1}  {2} links  {3}'.format(
+            entry['size'] / 2**20,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['used'])),
+            links, url))
+
+
+# download progress: filename -> [bytes done, bytes total]
+progress = {}
+progress_lock = threading.Lock()
+progress_last = [0.0]
+
+
+def progress_start(filename, total, done=0):
+    """Start tracking progress of filename's download."""
+    with progress_lock:
+        progress[filename] = [done, total]
+    progress_print(force=True)
+
+
+def progress_update(filename, nbytes):
+    """Record nbytes more of filename downloaded."""
+    with progress_lock:
+        progress[filename][0] += nbytes
+    progress_print()
+
+
+def progress_done(filename):
+    """Stop tracking progress of filename's download."""
+    with progress_lock:
+        progress.pop(filename, None)
+    progress_print(force=True)
+
+
+def progress_print(force=False):
+    """Print one status line covering every download in flight.
+
+    Downloads run interleaved, so each line summarizes all active files
+    rather than the most recent one; printing is throttled to 5 lines/s.
+    """
+    now = time.monotonic()
+    with progress_lock:
+        if not progress or (not force and now - progress_last[0] < 0.2):
+            return
+        progress_last[0] = now
+        status = []
+        for filename, (done, total) in sorted(progress.items()):
+            if total:
+                status.append('{0} {1:.0%}'.format(filename, done / total))
+            else:
+                status.append('{0} {1:.1f}MB'.format(filename, done / 2**20))
+        qprint('Downloading {0}\x1b[K'.format(', '.join(status)), end="\r")
+
+
+# metrics: stage -> totals of the work done in it
+metrics = {}
+metrics_lock = threading.Lock()
+memory_marks = {}               # running stage -> peak RSS while it runs
+memory_tracked = [False]        # whether stages mark memory, for --metrics
+rss_peak = [0]                  # peak RSS seen by marks, which reset the OS's
+
+
+@contextmanager
+def stage(name, rows=0, nbytes=0):
+    """Time the enclosed work as part of stage name.
+
+    Yields a dict whose 'rows' and 'bytes', starting at rows and nbytes,
+    are added to the stage's totals along with its wall and CPU time.
+    CPU time is the calling thread's, and stages run in several threads
+    at once, such as downloads, sum to more than the wall time spanned.
+    Stages may nest: when fetch parses a download as it streams in, the
+    download's time is also part of the parse's.
+
+    With --metrics, on Linux, the stage's peak RSS is the process's
+    highest while it ran; stages running at once share their peaks.
+    """
+    counts = {'rows': rows, 'bytes': nbytes}
+    key = object()
+    marked = False
+    if memory_tracked[0]:
+        with metrics_lock:
+            marked = memory_mark()
+            if marked:
+                memory_marks[key] = 0
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield counts
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        peak = None
+        if marked:
+            with metrics_lock:
+                memory_mark()
+                peak = memory_marks.pop(key)
+        record_stage(name, wall, cpu, counts['rows'], counts['bytes'],
+                     peak=peak)
+
+
+def memory_mark():
+    """Add the peak RSS since the last mark to each running stage's, then
+    reset the peak Linux keeps, VmHWM, to the RSS now.
+
+    Marks are made as stages start and end, so every stage sees each peak
+    reached while it runs.  Return False where the peak can't be reset.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            hwm = next(line for line in f if line.startswith('VmHWM:'))
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (OSError, StopIteration):
+        return False
+    peak = int(hwm.split()[1]) * 2**10
+    rss_peak[0] = max(rss_peak[0], peak)
+    for key in memory_marks:
+        memory_marks[key] = max(memory_marks[key], peak)
+    return True
+
+
+def track_memory():
+    """Mark the memory of each stage, as --metrics does."""
+    memory_tracked[0] = True
+
+
+def record_stage(name, wall=0.0, cpu=0.0, rows=0, nbytes=0, calls=1,
+                 peak=None):
+    """Add to the totals of stage name."""
+    with metrics_lock:
+        m = metrics.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0,
+                                      'rows': 0, 'bytes': 0, 'peak_rss': None})
+        m['wall'] += wall
+        m['cpu'] += cpu
+        m['calls'] += calls
+        m['rows'] += rows
+        m['bytes'] += nbytes
+        if peak is not None:
+            m['peak_rss'] = max(m['peak_rss'] or 0, peak)
+
+
+def merge_metrics(other):
+    """Add the stage totals other, such as a worker process's, to metrics."""
+    with metrics_lock:
+        for name, totals in other.items():
+            m = metrics.setdefault(name, dict.fromkeys(totals, 0))
+            for k, v in totals.items():
+                if k == 'peak_rss':
+                    m[k] = max(m[k] or 0, v or 0) or None
+                else:
+                    m[k] += v
+
+
+def timed(name, chunks):
+    """Yield from chunks, timing the work of producing each as stage name."""
+    chunks = iter(chunks)
+    while True:
+        with stage(name) as counts:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            counts['rows'] = len(chunk)
+        yield chunk
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in bytes."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss if sys.platform == 'darwin' else rss * 2**10
+    # memory_mark resets the peak getrusage reads on Linux
+    return max(rss, rss_peak[0])
+
+
+@contextmanager
+def metrics_report(path, name):
+    """Collect the metrics of the enclosed run of action name into JSON
+    at path; with --profile, also sample its stacks.
+    """
+    metrics.clear()
+    memory_tracked[0] = bool(path)
+    started = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    profile = option('profile')
+    sampler = stop = None
+    if profile:
+        samples = {}
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=sample_stacks, daemon=True,
+            args=(stop, option('profile_interval', 5.0) / 1000, samples))
+        sampler.start()
+    try:
+        yield
+    finally:
+        memory_tracked[0] = False
+        if sampler is not None:
+            stop.set()
+            sampler.join()
+            with open(str(profile), 'w') as f:
+                for key, count in sorted(samples.items()):
+                    f.write('{0} {1}\n'.format(key, count))
+        if path:
+            cpu = time.process_time() - cpu
+            if resource is not None:
+                children = resource.getrusage(resource.RUSAGE_CHILDREN)
+                cpu += children.ru_utime + children.ru_stime
+            report = {
+                'action': name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z',
+                                         time.localtime(started)),
+                'wall': time.perf_counter() - wall,
+                'cpu': cpu,
+                'peak_rss': peak_rss(),
+                'stages': metrics,
+            }
+            with open(str(path), 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+
+def sample_stacks(stop, interval, samples):
+    """Until stop is set, count the stacks of every other thread each
+    interval seconds into samples, as folded stacks: 'thread;outer;...;inner'.
+
+    The folded format is what flame graph tools, such as flamegraph.pl
+    and speedscope, read.
+    """
+    me = threading.get_ident()
+    while not stop.wait(interval):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(
+                    code.co_name, Path(code.co_filename).name,
+                    code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join([names.get(ident, str(ident))] + stack[::-1])
+            samples[key] = samples.get(key, 0) + 1
 
 
 def proceed(prompt):
     """User permission to proceed."""
     while True:
-        print(prompt)
+        report(prompt)
         try:
-            choice = stb(input().lower())
+            choice = strtobool(input().lower())
             return choice
         except ValueError:
-            print("Please respond with 'yes' or 'no'.")
+            report("Please respond with 'yes' or 'no'.")
+
+
+def strtobool(answer):
+    """Interpret answer, such as 'y', 'yes' or 'off', as True or False."""
+    if answer in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if answer in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError('invalid truth value {0!r}'.format(answer))
+
+
+def option(name, default=None):
+    """Look up a command line option, falling back to default."""
+    return getattr(args, name, default)
+
+
+def parse_size(size):
+    """Parse a byte count such as 1048576, 512K, 64M or 2G."""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
 
 
 def qprint(*pargs, **pkwargs):
-    """Quiet printing."""
+    """Quiet printing; to stderr while data is written to stdout."""
     global args
     if not args.quiet:
-        print(*pargs, **pkwargs, flush=True)
+        report(*pargs, **pkwargs)
+
+
+def report(*pargs, **pkwargs):
+    """Print a message, such as an error or a prompt, for the user; to
+    stderr while data is written to stdout.
+    """
+    out = sys.stderr if option('output') == '-' else sys.stdout
+    print(*pargs, **pkwargs, file=out, flush=True)
 
 
 def check_directory_download(p):
@@ -740,111 +1982,1442 @@ def check_directory_download(p):
                 sys.exit(1)
     else:
         msg = 'Director {0} does not exist; make it and try again.'
-        print(msg.format(str(p)))
+        report(msg.format(str(p)))
+        sys.exit(1)
+    return p
+
+
+def check_directory_update(p):
+    """Check directory (p, a Path) is appropriate for updating: exists."""
+    if not p.exists() or not p.is_dir():
+        msg = 'Director {0} does not exist; make it and try again.'
+        report(msg.format(str(p)))
         sys.exit(1)
     return p
 
 
+def load_fips(spec):
+    """Load the FIPS codes named by spec as fips_codes does, exiting if
+    there are none.
+    """
+    try:
+        return fips_codes(spec)
+    except ValueError as e:
+        report(e)
+        sys.exit(1)
+
+
+def fips_codes(spec):
+    """Load the FIPS codes named by spec into a set of zero padded codes.
+
+    spec is a comma separated list of codes or a file of them, one per
+    line or in a column named fips.  Raises ValueError if it has none.
+    """
+    path = Path(spec)
+    if path.is_file():
+        try:
+            table = pd.read_csv(path, dtype=str)
+            if 'fips' in table:
+                codes = table['fips'].dropna()
+            else:
+                codes = pd.read_csv(path, dtype=str, header=None)[0].dropna()
+        except pd.errors.EmptyDataError:
+            codes = []
+    else:
+        codes = spec.split(',')
+    fips = {code.strip().zfill(5) for code in codes if code.strip()}
+    if not fips:
+        raise ValueError('No FIPS codes found in {0}.'.format(spec))
+    return fips
+
+
 def check_directory_consolidate(p):
     """Check directory (p, a Path) is appropriate for consolidating: exists."""
     # TODO check directory for appropriate files.
     if not p.exists() or not p.is_dir():
         msg = 'Director {0} does not exist; download data first and try again.'
-        print(msg.format(str(p)))
+        report(msg.format(str(p)))
         sys.exit(1)
     return p
 
 
 def convert_dtypes(df, dtypes):
-    """Convert df's variables to specified dtypes."""
-    ints, flts, strs = dtypes
-    df[ints] = df[ints].astype('int8') if ints else None
-    df[flts] = df[flts].astype('float32') if flts else None
-    df[strs] = df[strs].astype('str') if strs else None
+    """Convert df's variables, in place, to dtypes from get_dtypes.
+
+    Integers take the narrowest type that holds their range, nullable if
+    any are missing; floats are float64; categories become categoricals;
+    strings stay strings.  Missing values stay missing and variables not
+    in df are skipped.
+    """
+    ints, flts, strs, cats = dtypes
+    for k in ints:
+        if k in df:
+            df[k] = narrow_int(df[k])
+    for k in flts:
+        if k in df and df[k].dtype != 'float64':
+            df[k] = df[k].astype('float64')
+    for k in strs + cats:
+        if k in df and pd.api.types.is_numeric_dtype(df[k].dtype):
+            df[k] = df[k].astype(str).where(df[k].notna())
+    for k in cats:
+        if k in df and df[k].dtype != 'category':
+            df[k] = df[k].astype('category')
     return df
 
 
-def get_dtypes(agency_dict):
-    """Get dtypes from agency's schema."""
-    items = agency_dict['dtype'].items()
-    ints = [k for k, v in items if v == int]
-    flts = [k for k, v in items if v == float]
-    strs = [k for k, v in items if v == str]
-    return [ints, flts, strs, ]
+int_types = ['int8', 'int16', 'int32', 'int64']
 
 
-agencies = {'bls': bls,
-            'epa': epa}
+def narrow_int(values):
+    """Cast values to the narrowest integer type holding their range.
 
+    Missing values call for the nullable types, Int8 through Int64, and
+    values that are not whole numbers raise a ValueError.
+    """
+    if not pd.api.types.is_numeric_dtype(values.dtype):
+        values = pd.to_numeric(values)
+    if pd.api.types.is_float_dtype(values.dtype) and (values % 1).any():
+        raise ValueError('{0} holds fractional values'.format(values.name))
+    nullable = bool(values.isna().any())
+    lo, hi = values.min(), values.max()
+    for t in int_types:
+        if nullable and pd.isna(lo):
+            break
+        info = np.iinfo(t)
+        if info.min <= lo and hi <= info.max:
+            break
+    else:
+        raise OverflowError('{0} exceeds int64'.format(values.name))
+    return values.astype(t.capitalize() if nullable else t)
 
-# cli: program
 
-parser = argparse.ArgumentParser(
-    prog='fd',
-    description='Provide analysis ready US federal data.'
-)
-
-parser.add_argument(
-    '-d',
-    '--directory',
-    default=Path.home() / 'fdata',
-    type=Path,
-    help='set directory for fd to use'
-)
-
-parser.add_argument(
-    '-q',
-    '--quiet',
-    action='store_true',
-    help='do not print status along the way'
-)
-
-parser.add_argument(
-    '-v',
-    '--version',
-    action='version',
-    version='%(prog)s v0.1'
-)
-
-# cli: actions
-
-subparser = parser.add_subparsers(
-    help='actions to perform on federal agencies',
-    metavar='action',
-    dest='action'
-)
-
-# cli available
-
-parser_available = subparser.add_parser(
-    'available',
-    aliases='a',
-    description=("Print available agencies "
-                 "or available datasets relative to a specified agency."),
-    help="list available agencies or an agency's datasets",
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog="""examples:
+# integers parse as float64, which tolerates missing values and is far
+# faster than the nullable Int64 parser; convert_dtypes narrows them
+parse_types = {str: str, float: 'float64', int: 'float64', 'category': 'category'}
 
-  $ fd available
 
-  $ fd available bls
+def read_args(agency_dict):
+    """Compile agency's schema into keyword arguments for pd.read_csv.
+
+    With these the parser produces the declared types itself, rather than
+    inferring them for convert_dtypes to correct; only integers are left
+    to narrow.  Columns the schema does not declare are not read.
     """
-)
+    dtype = {k: parse_types[v] for k, v in agency_dict['dtype'].items()}
+    for source, k in agency_dict.get('rename', {}).items():
+        dtype[source] = dtype[k]
+    return {
+        'dtype': dtype,
+        'usecols': dtype.__contains__,
+        'na_values': agency_dict.get('na_values'),
+    }
 
-parser_available.add_argument(
-    'agency',
-    help='list datasets from specified agency',
-    metavar='agency',
-    type=str.lower,
-    nargs='?',
-    default=None
-)
 
+chunk_rows = 10000              # rows per chunk without a memory limit
+chunk_copies = 4                # copies of a chunk alive while it's handled
+probe_rows = 100                # rows of the first chunk, with a memory limit
 
-def available(args):
-    """Print available agencies or their datasets."""
-    ag = args.agency
-    if ag:
+
+def read_chunks(reader, memory_limit=None):
+    """Yield the chunks of reader, a pd.read_csv opened with iterator=True.
+
+    Without memory_limit chunks are chunk_rows rows.  With it, the first
+    chunk is a probe of probe_rows rows, and each after it is sized from
+    the bytes per row the chunks before it took in memory, so that
+    chunk_copies copies of a chunk, as it is parsed, joined, converted
+    and written, fit in memory_limit bytes.  Past chunk_rows, chunks grow
+    by at most four times at a step, and the estimate follows wider rows
+    at once but narrower ones slowly, so one unusual chunk can't overshoot.
+    """
+    rows = probe_rows if memory_limit else chunk_rows
+    row_bytes = None
+    with reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(rows)
+            except StopIteration:
+                return
+            if memory_limit and len(chunk):
+                measured = chunk.memory_usage(deep=True).sum() / len(chunk)
+                row_bytes = measured if row_bytes is None else max(
+                    measured, 0.75 * row_bytes + 0.25 * measured)
+                fit = int(memory_limit / (chunk_copies * row_bytes))
+                rows = max(probe_rows, min(fit, max(chunk_rows, 4 * rows)))
+            yield chunk
+
+
+def get_dtypes(agency_dict):
+    """Get dtypes from agency's schema."""
+    items = agency_dict['dtype'].items()
+    ints = [k for k, v in items if v == int]
+    flts = [k for k, v in items if v == float]
+    strs = [k for k, v in items if v == str]
+    cats = [k for k, v in items if v == 'category']
+    return [ints, flts, strs, cats, ]
+
+
+def index_dimension(table, key):
+    """Index a dimension table on key, once, for attach_dimension.
+
+    Text columns are stored as categoricals so that attaching them to a
+    chunk takes integer codes instead of copying strings.  Rows repeating
+    an earlier key are dropped.
+    """
+    table = table.drop_duplicates(key)
+    columns = {}
+    for name in table.columns.drop(key):
+        values = table[name]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = values.astype('category')
+        columns[name] = values.array
+    return {'key': key, 'index': pd.Index(table[key]), 'columns': columns}
+
+
+def attach_dimension(chunk, dimension):
+    """Attach an indexed dimension's columns to chunk.
+
+    Equivalent to a left pd.merge on the dimension's key, but the key's
+    hash table is built once per dimension rather than once per chunk and
+    each column is a positional take; unmatched rows get missing values.
+    """
+    keys = chunk[dimension['key']]
+    if keys.dtype == 'category':
+        # look up each distinct key once, then expand by the codes
+        positions = dimension['index'].get_indexer(keys.cat.categories)
+        positions = np.append(positions, -1)[keys.cat.codes]
+    else:
+        positions = dimension['index'].get_indexer(keys)
+    columns = {name: pd.api.extensions.take(values, positions, allow_fill=True)
+               for name, values in dimension['columns'].items()}
+    return pd.concat([chunk, pd.DataFrame(columns, index=chunk.index)], axis=1)
+
+
+def spool_chunks(chunks, source, path, *pargs):
+    """Pickle each chunk of chunks(source, *pargs) to path, in a worker
+    process.
+
+    Return path and the metrics of the stages the worker ran.
+    """
+    metrics.clear()
+    with open(str(path), 'wb') as f:
+        for chunk in chunks(source, *pargs):
+            with stage('spool', rows=len(chunk)):
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path, dict(metrics)
+
+
+def unspool_chunks(path):
+    """Yield the chunks pickled to path by spool_chunks, then delete path."""
+    try:
+        with open(str(path), 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+    finally:
+        Path(path).unlink()
+
+
+# consolidated output
+outputs = {}                    # format -> writer
+output_names = {}               # format -> output's name within d
+compressions = {'gzip': '.gz', 'bz2': '.bz2', 'zstd': '.zst'}  # -> suffix
+consolidate_manifest_name = '.fd-consolidate.json'
+
+
+def output(name):
+    """Register a writer for the format fn.__name__, less '_output'.
+
+    Writers are context managers called with the dataset directory d, its
+    schema agency_dict and the layout of any output kept from an earlier
+    run, and yield a function write(chunk, source); name is the output's
+    file or directory within d.
+    """
+    def register(fn):
+        fmt = fn.__name__[:-len('_output')]
+        outputs[fmt] = fn
+        output_names[fmt] = name
+        return fn
+    return register
+
+
+def output_name(fmt, compress=None):
+    """Name within d of the output of format fmt, compressed with compress."""
+    return output_names[fmt] + compressions.get(compress, '')
+
+
+@contextmanager
+def consolidate_output(d, agency_dict, sources, rebuild=False, settings=None):
+    """Yield (stale, write): the sources, name -> files, new or changed
+    since d was last consolidated in --format, and a writer for their chunks.
+    """
+    fmt = option('format', 'csv')
+    compress = option('compress')
+    if compress and fmt != 'csv':
+        report('--compress applies to csv output; {0} output is compressed '
+               'already.'.format(fmt))
+        sys.exit(1)
+    if option('output'):
+        if fmt != 'csv':
+            report('--output streams csv; {0} output is only written to {1}.'
+                   .format(fmt, d))
+            sys.exit(1)
+        # stream every source; d's output and manifest are left alone
+        with csv_stream(option('output'), compress) as write:
+            yield list(sources), timed_write(write)
+        return
+    # the manifest holds, per format, its settings, the writer's layout and
+    # each source's file signatures and slice of the output; a change of
+    # settings, such as filters or --compress, rebuilds the output
+    settings = dict(settings or {}, format=fmt)
+    if compress:
+        settings['compress'] = compress
+    manifest_path = d / consolidate_manifest_name
+    manifest = {}
+    if manifest_path.exists():
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+
+    previous = manifest.pop(fmt, {})
+    if (rebuild or option('rebuild', False) or
+            previous.get('settings') != settings or
+            not (d / output_name(fmt, compress)).exists()):
+        previous = {}
+    recorded = previous.get('sources', {})
+    if previous:
+        files = {
+            name: {p.name: file_signature(
+                p, recorded.get(name, {}).get('files', {}).get(p.name))
+                for p in paths}
+            for name, paths in sources.items()
+        }
+        stale = [name for name in sources
+                 if recorded.get(name, {}).get('files') != files[name]]
+    else:
+        files, stale = {}, list(sources)
+    layout = previous.get('layout', {})
+    layout['slices'] = {name: recorded[name]['slice'] for name in sources
+                        if name not in stale and recorded[name]['slice']}
+    if sources and not stale and len(recorded) == len(sources):
+        qprint('{0} unchanged since last consolidated\x1b[K.'.format(d))
+
+    # the output is inconsistent with the manifest until the writer is done
+    with manifest_path.open('w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    with outputs[fmt](d, agency_dict, layout) as write:
+        yield stale, timed_write(write)
+
+    # rebuilt sources are signed now: with fetch, they were still arriving
+    for name, paths in sources.items():
+        if name not in files:
+            files[name] = {p.name: file_signature(p) for p in paths}
+    slices = layout.pop('slices')
+    manifest[fmt] = {
+        'settings': settings,
+        'layout': layout,
+        'sources': {name: {'files': files[name], 'slice': slices.get(name)}
+                    for name in sources},
+    }
+    with manifest_path.open('w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+# rollups: totals of a dataset's measures by group keys, kept as side tables
+rollup_keys = {                 # derived group key -> its values in a chunk
+    'state': lambda chunk: chunk['area_fips'].str[:2],
+}
+partials_merged = 16            # partial aggregates held before merging
+
+
+def rollup_specs(agency_dict):
+    """The rollups asked for by --rollup: name -> group keys.
+
+    Each spec, such as "year,state", names the schema's columns, other
+    than the measures, or keys derived in rollup_keys; the rollup's name
+    joins them with '-'.  The schema's rollups['by'] keys are added to
+    every rollup.
+    """
+    specs = option('rollup') or []
+    if specs and 'rollups' not in agency_dict:
+        report("--rollup applies to bls:cew only.")
+        sys.exit(1)
+    rollups = {}
+    for spec in specs:
+        keys = [k.strip() for k in spec.split(',') if k.strip()]
+        for k in keys:
+            if k not in rollup_keys and (
+                    k not in agency_dict['dtype'] or
+                    k in agency_dict['rollups']['measures']):
+                report("Can't roll up by {0}.".format(k))
+                sys.exit(1)
+        by = [k for k in agency_dict['rollups']['by'] if k not in keys]
+        rollups['-'.join(keys)] = keys + by
+    return rollups
+
+
+@contextmanager
+def rollup_output(d, agency_dict, rollups, sources, stale):
+    """Yield add(chunk, source), adding chunk to each of rollups, from
+    rollup_specs, while the stale of sources in d are consolidated.
+
+    Each chunk is reduced to a partial aggregate: the sums of the schema's
+    rollups['measures'] and a count of rows, by the rollup's keys.  These
+    merge by summing again, so each source's are merged as it is read and
+    kept in d/rollups/parts/NAME/SOURCE.csv; a later run only aggregates
+    the sources consolidated again.  Once every chunk is added, each
+    rollup's sources are merged into d/rollups/NAME.csv.
+    """
+    if not rollups:
+        yield lambda chunk, source: None
+        return
+    measures = agency_dict['rollups']['measures']
+    partials = {name: {} for name in rollups}   # name -> source -> [partial]
+
+    def add(chunk, source):
+        with stage('rollup', rows=len(chunk)):
+            for name, keys in rollups.items():
+                parts = partials[name].setdefault(source, [])
+                parts.append(rollup_chunk(chunk, keys, measures))
+                if len(parts) > partials_merged:
+                    parts[:] = [merge_partials(parts, keys, measures)]
+
+    yield add
+
+    for name, keys in rollups.items():
+        parts = d / 'rollups' / 'parts' / name
+        parts.mkdir(parents=True, exist_ok=True)
+        for source in stale:
+            merge_partials(partials[name].get(source, []), keys,
+                           measures).to_csv(parts / (source + '.csv'),
+                                            index=False)
+        for path in parts.glob('*.csv'):
+            if path.name[:-len('.csv')] not in sources:
+                path.unlink()
+        dtype = dict.fromkeys(keys, str)
+        table = merge_partials([pd.read_csv(path, dtype=dtype)
+                                for path in sorted(parts.glob('*.csv'))],
+                               keys, measures)
+        table.sort_values(keys).to_csv(d / 'rollups' / (name + '.csv'),
+                                       index=False)
+
+
+def rollup_chunk(chunk, keys, measures):
+    """Partial aggregate of chunk: the sum of each of measures, and the
+    count of rows, by keys.  Numeric keys holding whole numbers, such as
+    bls:cew's qtr, are grouped as integers.
+    """
+    groups = pd.DataFrame(
+        {k: rollup_keys[k](chunk) if k in rollup_keys else chunk[k]
+         for k in keys}, index=chunk.index)
+    for k in keys:
+        if pd.api.types.is_float_dtype(groups[k].dtype):
+            try:
+                groups[k] = narrow_int(groups[k])
+            except ValueError:
+                pass
+    groups = groups.astype(object)
+    groups[measures] = chunk[measures]
+    grouped = groups.groupby(keys, dropna=False, sort=False)
+    partial = grouped[measures].sum()
+    partial['rows'] = grouped.size()
+    return partial.reset_index()
+
+
+def merge_partials(parts, keys, measures):
+    """Merge partial aggregates by keys into one, summing them again."""
+    parts = [p for p in parts if len(p)]
+    if not parts:
+        return pd.DataFrame(columns=keys + measures + ['rows'])
+    merged = pd.concat(parts, ignore_index=True)
+    merged[keys] = merged[keys].astype(object)
+    return merged.groupby(keys, dropna=False, sort=False).sum().reset_index()
+
+
+def timed_write(write):
+    """Wrap write(chunk, source) to time it as the write stage."""
+    def write_chunk(chunk, source):
+        with stage('write', rows=len(chunk)):
+            write(chunk, source)
+    return write_chunk
+
+
+def file_signature(path, previous=None):
+    """Size, mtime and SHA-256 of path.
+
+    The hash is only recomputed when size or mtime differ from previous,
+    an earlier signature of path.
+    """
+    stat = path.stat()
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if previous and all(previous.get(k) == v for k, v in signature.items()):
+        signature['sha256'] = previous['sha256']
+        return signature
+    signature['sha256'] = file_sha256(path)
+    return signature
+
+
+def file_sha256(path):
+    """Hex SHA-256 of the contents of path."""
+    sha = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@output('data.csv')
+@contextmanager
+def csv_output(d, agency_dict, layout):
+    """Write chunks to d/data.csv, compressed as --compress says."""
+    compress = option('compress')
+    csvfile = d / output_name('csv', compress)
+    slices = layout['slices']
+    if not slices:
+        layout.pop('header', None)
+        # drop the output of another codec, or of none
+        for c in [None] + list(compressions):
+            if c != compress and (d / output_name('csv', c)).exists():
+                (d / output_name('csv', c)).unlink()
+    # each source's rows are a slice of the file, by byte offset and length:
+    # kept slices past the first gap are moved up, then new ones appended
+    end = layout.get('header', 0)
+    for s in sorted(slices.values(), key=lambda s: s['offset']):
+        if s['offset'] != end:
+            break
+        end += s['length']
+
+    with csvfile.open('r+b' if slices else 'wb') as f, \
+            tempfile.TemporaryFile(dir=str(d)) as spill:
+        tail = sorted((s for s in slices.values() if s['offset'] >= end),
+                      key=lambda s: s['offset'])
+        for s in tail:
+            f.seek(s['offset'])
+            copy_bytes(f, spill, s['length'])
+        f.seek(end)
+        f.truncate()
+        spill.seek(0)
+        for s in tail:
+            s['offset'] = f.tell()
+            copy_bytes(spill, f, s['length'])
+
+        def append(data, rows, source):
+            if source not in slices:
+                slices[source] = {'offset': f.tell(), 'length': 0, 'rows': 0}
+            n = f.write(data)
+            slices[source]['length'] += n
+            record_stage('write', nbytes=n, calls=0)
+            slices[source]['rows'] += rows
+
+        # compressed, each chunk is a member of its own, which decompressors
+        # read on as one stream, so slices stay byte ranges of the file
+        with member_writer(compress, append) as put:
+            def write(chunk, source):
+                if 'header' not in layout:
+                    layout['header'] = f.write(compress_member(
+                        compress, chunk.iloc[:0].to_csv(index=False).encode()))
+                data = chunk.to_csv(header=False, index=False,
+                                    float_format='%.2f')
+                put(data.encode(), len(chunk), source)
+
+            yield write
+
+
+@contextmanager
+def csv_stream(path, compress=None):
+    """Write chunks as CSV to path, or to stdout if path is -, as they come.
+
+    Used for --output: nothing is kept for a later run, so the chunks of
+    every source are written and the stream can be piped into another
+    program; --compress compresses the stream as it does data.csv.
+    """
+    with (nullcontext(sys.stdout.buffer) if path == '-'
+          else open(str(path), 'wb')) as f:
+        def append(data):
+            record_stage('write', nbytes=f.write(data), calls=0)
+
+        header = []
+        with member_writer(compress, append) as put:
+            def write(chunk, source):
+                if not header:
+                    header.append(chunk.iloc[:0].to_csv(index=False))
+                    put(header[0].encode())
+                data = chunk.to_csv(header=False, index=False,
+                                    float_format='%.2f')
+                put(data.encode())
+
+            yield write
+        f.flush()
+
+
+@contextmanager
+def member_writer(compress, append):
+    """Yield put(data, *info), which passes bytes data, compressed as one
+    member by compress_member, to append(member, *info), in order.
+
+    Members are compressed by a pool of threads, with at most twice as
+    many waiting to be appended as there are threads.  Without compress,
+    put is append.
+    """
+    if not compress:
+        yield append
+        return
+    workers = os.cpu_count() or 1
+    pending = deque()               # (future member, info)
+
+    def compressed(data):
+        with stage('compress', nbytes=len(data)):
+            return compress_member(compress, data)
+
+    def put(data, *info):
+        pending.append((pool.submit(compressed, data), info))
+        while len(pending) > 2 * workers:
+            member, info = pending.popleft()
+            append(member.result(), *info)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield put
+        while pending:
+            member, info = pending.popleft()
+            append(member.result(), *info)
+
+
+def compress_member(compress, data):
+    """Compress bytes data as one whole gzip member, bz2 stream or zstd
+    frame, as compress names; without compress, return data.
+    """
+    if compress == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compress == 'bz2':
+        return bz2.compress(data)
+    if compress == 'zstd':
+        return import_zstandard().ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def open_compressed(path, compress=None):
+    """Open path for reading as bytes, decompressing all of its members."""
+    if compress == 'gzip':
+        return gzip.open(str(path), 'rb')
+    if compress == 'bz2':
+        return bz2.open(str(path), 'rb')
+    if compress == 'zstd':
+        return import_zstandard().ZstdDecompressor().stream_reader(
+            open(str(path), 'rb'), read_across_frames=True, closefd=True)
+    return open(str(path), 'rb')
+
+
+def import_zstandard():
+    """Import zstandard, which zstd compression needs but fd does not
+    require.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        report('zstd compression needs zstandard; pip install zstandard.')
+        sys.exit(1)
+    return zstandard
+
+
+def copy_bytes(src, dst, n):
+    """Copy n bytes from file src to file dst."""
+    while n > 0:
+        block = src.read(min(n, 2**20))
+        if not block:
+            raise EOFError('{0} ended {1} bytes early'.format(src.name, n))
+        dst.write(block)
+        n -= len(block)
+
+
+row_group_rows = 2**17          # rows per Parquet row group
+buffered_rows = 2**20           # rows held across all partitions at once
+
+
+@output('data.parquet')
+@contextmanager
+def parquet_output(d, agency_dict, layout):
+    """Write chunks to the Parquet dataset d/data.parquet.
+
+    The dataset is hive partitioned, year=YYYY/SOURCE.parquet, on the year
+    found in the dataset's partition column, with one file per source and
+    partition; layout['slices'] lists each source's files.  Rows are
+    buffered per partition and flushed as zstd compressed row groups;
+    column types come from agency_dict['dtype'].
+    """
+    pa, pq = import_pyarrow()
+    root = d / 'data.parquet'
+    slices = layout['slices']
+    metadata = root / '_common_metadata'
+    if not slices and root.exists():
+        shutil.rmtree(str(root))
+    root.mkdir(exist_ok=True)
+    kept = {f for s in slices.values() for f in s['files']}
+    for path in root.glob('year=*/*.parquet'):
+        if str(path.relative_to(root)) not in kept:
+            path.unlink()
+
+    key = agency_dict['partition']
+    schema = [pq.read_schema(str(metadata))] if slices else []
+    writers = {}                    # year -> pq.ParquetWriter, of source
+    buffers = {}                    # year -> [pa.Table]
+    counts = {}                     # year -> rows buffered
+    source = [None]
+
+    def flush(year):
+        table = pa.concat_tables(buffers.pop(year))
+        del counts[year]
+        if year not in writers:
+            name = 'year={0}/{1}.parquet'.format(year, source[0])
+            (root / name).parent.mkdir(exist_ok=True)
+            writers[year] = pq.ParquetWriter(str(root / name), table.schema,
+                                             compression='zstd')
+            slices[source[0]]['files'].append(name)
+        writers[year].write_table(table, row_group_size=row_group_rows)
+
+    def close():
+        for year in list(buffers):
+            flush(year)
+        for w in writers.values():
+            w.close()
+        writers.clear()
+
+    def write(chunk, name):
+        if name != source[0]:
+            close()
+            source[0] = name
+            slices[name] = {'files': [], 'rows': 0}
+        if not schema:
+            schema.append(arrow_schema(chunk, agency_dict))
+            pq.write_metadata(schema[0], str(metadata))
+        slices[name]['rows'] += len(chunk)
+        years = partition_years(chunk[key])
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        table = table.cast(schema[0])
+        if key == 'year':
+            table = table.drop(['year'])
+        for year in years.unique():
+            rows = (years == year).to_numpy().nonzero()[0]
+            buffers.setdefault(year, []).append(table.take(rows))
+            counts[year] = counts.get(year, 0) + len(rows)
+            if counts[year] >= row_group_rows:
+                flush(year)
+        while sum(counts.values()) > buffered_rows:
+            flush(max(counts, key=counts.get))
+
+    try:
+        yield write
+    finally:
+        close()
+
+
+def partition_years(column):
+    """Find the four digit year in each value of column, else 'unknown'."""
+    years = column.astype(str).str.extract(r'([0-9]{4})', expand=False)
+    return years.fillna('unknown')
+
+
+def arrow_schema(chunk, agency_dict):
+    """Arrow schema for chunk's columns, typed by agency_dict['dtype']."""
+    pa, pq = import_pyarrow()
+    types = {str: pa.string(), float: pa.float64(), int: pa.int64(),
+             'category': pa.dictionary(pa.int32(), pa.string())}
+    fields = []
+    for field in pa.Schema.from_pandas(chunk, preserve_index=False):
+        t = types.get(agency_dict['dtype'].get(field.name))
+        if t is None and pa.types.is_dictionary(field.type):
+            t = field.type.value_type
+        t = t or field.type
+        if pa.types.is_null(t):
+            t = pa.string()
+        fields.append(pa.field(field.name, t))
+    return pa.schema(fields)
+
+
+def import_pyarrow():
+    """Import pyarrow, which Parquet output needs but fd does not require."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        report('Parquet support needs pyarrow; pip install pyarrow.')
+        sys.exit(1)
+    return pyarrow, pyarrow.parquet
+
+
+sqlite_types = {str: 'TEXT', 'category': 'TEXT', float: 'REAL', int: 'INTEGER'}
+sqlite_pragmas = [              # for bulk loading: the output is rebuilt
+    'PRAGMA journal_mode = OFF',    # whole if a load is interrupted
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',  # KiB
+]
+
+
+@output('data.sqlite')
+@contextmanager
+def sqlite_output(d, agency_dict, layout):
+    """Write chunks to the SQLite database d/data.sqlite.
+
+    Rows go to the table facts, less the columns of agency_dict's
+    dimensions, (table, key, columns) in the order they are split off:
+    each dimension's columns are stored once per key in its own table,
+    and a view, data, joins them back into the rows as consolidated.
+    layout['slices'] gives each source's id in facts' _source column, so
+    the rows of sources not kept are deleted.  Chunks are loaded in one
+    transaction with executemany, and agency_dict's indexes are dropped
+    for any load or delete and built once it is done.
+    """
+    path = d / 'data.sqlite'
+    slices = layout['slices']
+    if not slices:
+        layout.pop('columns', None)
+        if path.exists():
+            path.unlink()
+    indexes = agency_dict.get('indexes', [])
+    con = sqlite3.connect(str(path), isolation_level=None)
+    try:
+        for pragma in sqlite_pragmas:
+            con.execute(pragma)
+        con.execute('BEGIN')
+        changed = []
+
+        def change():
+            # indexes slow a bulk load; drop them until it is done
+            if not changed:
+                changed.append(True)
+                for k in indexes:
+                    con.execute('DROP INDEX IF EXISTS {0}'.format(
+                        sqlite_name('index_' + k)))
+
+        ids = [s['id'] for s in slices.values()]
+        # layout['ids'] lists the sources facts held when last written
+        if slices and set(layout.get('ids', [None])) - set(ids):
+            change()
+            con.execute('DELETE FROM facts WHERE _source NOT IN ({0})'.format(
+                ','.join('?' * len(ids))), ids)
+        next_id = max([s['id'] for s in slices.values()], default=0) + 1
+        tables = {}                 # table -> its columns, once created
+
+        def insert(table, frame, verb='INSERT'):
+            if table not in tables:
+                tables[table] = list(frame.columns)
+                columns = ', '.join(
+                    '{0} {1}'.format(sqlite_name(k),
+                                     sqlite_type(frame[k], agency_dict))
+                    for k in frame.columns)
+                if table != 'facts':
+                    columns += ', PRIMARY KEY ({0})'.format(
+                        sqlite_name(frame.columns[0]))
+                con.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+                    sqlite_name(table), columns))
+            con.executemany('{0} INTO {1} VALUES ({2})'.format(
+                verb, sqlite_name(table), ','.join('?' * frame.shape[1])),
+                sqlite_rows(frame[tables[table]]))
+
+        def write(chunk, source):
+            nonlocal next_id
+            change()
+            if source not in slices:
+                slices[source] = {'id': next_id, 'rows': 0}
+                next_id += 1
+            if 'columns' not in layout:
+                layout['columns'] = list(chunk.columns)
+            for table, key, columns in dimensions(chunk, agency_dict):
+                insert(table, chunk[[key] + columns].drop_duplicates(key),
+                       'INSERT OR IGNORE')
+                chunk = chunk.drop(columns=columns)
+            insert('facts', chunk.assign(_source=slices[source]['id']))
+            slices[source]['rows'] += len(chunk)
+
+        yield write
+
+        if changed and 'columns' in layout:
+            con.execute('DROP VIEW IF EXISTS data')
+            con.execute('CREATE VIEW data AS ' + sqlite_view(
+                layout['columns'], dimensions(
+                    pd.DataFrame(columns=layout['columns']), agency_dict)))
+            facts = [row[1] for row in con.execute('PRAGMA table_info(facts)')]
+            for k in indexes:
+                if k in facts:
+                    con.execute('CREATE INDEX {0} ON facts ({1})'.format(
+                        sqlite_name('index_' + k), sqlite_name(k)))
+        con.execute('COMMIT')
+        layout['ids'] = sorted(s['id'] for s in slices.values())
+        con.execute('PRAGMA optimize')
+    finally:
+        con.close()
+
+
+def dimensions(chunk, agency_dict):
+    """agency_dict's dimensions, (table, key, columns), as they apply to
+    chunk: only the columns chunk has, and only dimensions with any.
+    """
+    found = []
+    for table, key, columns in agency_dict.get('dimensions', []):
+        columns = [k for k in columns if k in chunk]
+        if key in chunk and columns:
+            found.append((table, key, columns))
+    return found
+
+
+def sqlite_view(columns, dims):
+    """SELECT of columns from facts joined to the tables of dims, the
+    dimensions split off facts in that order.
+    """
+    owner = dict.fromkeys(columns, 'facts')     # column -> its table
+    for table, key, cs in dims:
+        owner.update(dict.fromkeys(cs, table))
+    select = ', '.join('{0}.{1}'.format(sqlite_name(owner[k]), sqlite_name(k))
+                       for k in columns)
+    # a dimension's key is held by a dimension split off after it, or facts
+    joins = ''.join(' LEFT JOIN {0} ON {0}.{1} = {2}.{1}'.format(
+        sqlite_name(table), sqlite_name(key), sqlite_name(owner[key]))
+        for table, key, _ in reversed(dims))
+    return 'SELECT {0} FROM facts{1}'.format(select, joins)
+
+
+def sqlite_name(name):
+    """Quote name as an SQLite identifier."""
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def sqlite_type(column, agency_dict):
+    """SQLite type of column, as agency_dict declares it or as it's held."""
+    t = agency_dict['dtype'].get(column.name)
+    if t is None:
+        t = (int if pd.api.types.is_integer_dtype(column) else
+             float if pd.api.types.is_float_dtype(column) else str)
+    return sqlite_types[t]
+
+
+def sqlite_rows(frame):
+    """Rows of frame as tuples of Python values, with None for missing."""
+    columns = []
+    for k in frame.columns:
+        column = frame[k]
+        if column.hasnans:
+            column = column.astype(object).where(column.notna(), None)
+        columns.append(column.tolist())
+    return zip(*columns)
+
+
+matrix_record = [('row', '<i4'), ('column', '<i4'), ('value', '<f8')]
+
+
+@output('data.matrix')
+@contextmanager
+def matrix_output(d, agency_dict, layout):
+    """Write chunks to d/data.matrix as a dense array of agency_dict's
+    matrix value, a row per series and a column per (year, period).
+
+    values.npy holds the array, float64 with NaN where a series has no
+    value, to be memory mapped; series.txt lists each row's series_id and
+    periods.csv each column's year and period, both sorted.  Chunks are
+    read once: each row's (row, column, value) is spooled to a temporary
+    file as series and periods are numbered in order of appearance, and
+    once every chunk is written the array is sized and filled from it.
+    Sources' values are not told apart, so the datasets with a matrix
+    are consolidated from one source: kept, the matrix is left as is.
+    """
+    matrix = agency_dict.get('matrix')
+    if matrix is None:
+        report('--format matrix applies to bls:ce and bls:sm only.')
+        sys.exit(1)
+    root = d / 'data.matrix'
+    slices = layout['slices']
+    record = np.dtype(matrix_record)
+    series, periods = {}, {}    # series_id -> row, (year, period) -> column
+
+    def number(keys, numbers):
+        codes, uniques = pd.factorize(keys)
+        new = np.array([numbers.setdefault(k, len(numbers)) for k in uniques],
+                       dtype=record['row'])
+        return new[codes]
+
+    def write(chunk, source):
+        slices.setdefault(source, {'rows': 0})['rows'] += len(chunk)
+        chunk = chunk[chunk[matrix['value']].notna()]
+        chunk = chunk.dropna(subset=[matrix['rows']] + matrix['columns'])
+        records = np.empty(len(chunk), dtype=record)
+        records['row'] = number(chunk[matrix['rows']].to_numpy(), series)
+        records['column'] = number(pd.MultiIndex.from_arrays(
+            [chunk[k].to_numpy() for k in matrix['columns']]), periods)
+        records['value'] = chunk[matrix['value']].to_numpy('float64')
+        spool.write(records.tobytes())
+
+    with tempfile.TemporaryFile(dir=str(d)) as spool:
+        yield write
+        if not spool.tell():
+            if not slices and root.exists():
+                shutil.rmtree(str(root))
+            if slices:
+                return
+
+        # number series and periods in sorted order
+        with stage('matrix'):
+            rows, columns = sorted(series), sorted(periods)
+            row = np.empty(len(rows), dtype='int64')
+            row[[series[k] for k in rows]] = np.arange(len(rows))
+            column = np.empty(len(columns), dtype='int64')
+            column[[periods[k] for k in columns]] = np.arange(len(columns))
+
+            if root.exists():
+                shutil.rmtree(str(root))
+            root.mkdir()
+            values = np.lib.format.open_memmap(
+                str(root / 'values.npy'), mode='w+', dtype='float64',
+                shape=(len(rows), len(columns)))
+            values[:] = np.nan
+            spool.seek(0)
+            while True:
+                records = np.frombuffer(
+                    spool.read(record.itemsize * chunk_rows * chunk_copies),
+                    dtype=record)
+                if not len(records):
+                    break
+                values[row[records['row']],
+                       column[records['column']]] = records['value']
+            values.flush()
+            del values
+            (root / 'series.txt').write_text(''.join(
+                '{0}\n'.format(k) for k in rows))
+            pd.DataFrame(columns, columns=matrix['columns']).to_csv(
+                root / 'periods.csv', index=False)
+
+
+def open_matrix(d):
+    """Open d/data.matrix: its values, memory mapped, the series_id of each
+    row and the periods, a DataFrame of year and period, of each column.
+    """
+    root = d / 'data.matrix'
+    values = np.load(str(root / 'values.npy'), mmap_mode='r')
+    series = np.array((root / 'series.txt').read_text().splitlines(),
+                      dtype=str)
+    periods = pd.read_csv(root / 'periods.csv', dtype={'period': str})
+    return values, series, periods
+
+
+def matrix_rows(series, keys):
+    """Rows of the sorted series that hold keys, found by binary search,
+    in the order of keys; keys not held are skipped.
+    """
+    keys = np.asarray(keys, dtype=str)
+    rows = np.searchsorted(series, keys)
+    found = rows < len(series)
+    found[found] = series[rows[found]] == keys[found]
+    return rows[found]
+
+
+# query
+scanners = {}                   # format -> scanner
+scan_preference = ['parquet', 'sqlite', 'csv']
+comparisons = {'==': operator.eq, '=': operator.eq, '!=': operator.ne,
+               '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+
+
+def scanner(fn):
+    """Register a scanner of the consolidated output of format fn.__name__,
+    less '_scan'.
+
+    Scanners are called with the dataset directory d, its schema
+    agency_dict, the columns to read (None for all) and the conditions
+    from parse_where rows must meet, and yield DataFrames of the rows.
+    """
+    scanners[fn.__name__[:-len('_scan')]] = fn
+    return fn
+
+
+def query(d, agency_dict):
+    """Write the rows of d's consolidated data selected by --columns and
+    --where, as CSV, to --output or stdout.
+    """
+    columns = [c for cs in option('columns') or [] for c in cs.split(',')]
+    where = [parse_where(w, agency_dict) for w in option('where') or []]
+    for k in columns:
+        if k not in agency_dict['dtype']:
+            report("{0} has no column {1}.".format(d, k))
+            sys.exit(1)
+
+    out = option('output') or '-'
+    header = True
+    with (nullcontext(sys.stdout) if out == '-' else open(out, 'w')) as f:
+        for chunk in query_chunks(d, agency_dict, columns or None, where):
+            f.write(chunk.to_csv(header=header, index=False,
+                                 float_format='%.2f'))
+            header = False
+        if header and columns:
+            f.write(','.join(columns) + '\n')
+
+
+def query_chunks(d, agency_dict, columns=None, where=()):
+    """Yield chunks of d's consolidated data, projected onto columns and
+    restricted to rows meeting every condition in where.
+
+    The format scanned is --format, else the first of scan_preference
+    consolidated in d: a columnar output reads only the columns needed
+    and skips row groups and partitions the conditions rule out.  SQLite
+    comes first when a condition is on one of agency_dict's indexes.
+    """
+    consolidated = consolidated_formats(d)
+    fmt = option('format')
+    if fmt is None:
+        preference = scan_preference
+        if any(k in agency_dict.get('indexes', []) for k, _, _ in where):
+            preference = ['sqlite'] + preference
+        fmt = next((fmt for fmt in preference if fmt in consolidated), None)
+    if fmt not in consolidated:
+        report('{0} has no {1} consolidated data; consolidate it first.'.format(
+            d, fmt or 'queryable'))
+        sys.exit(1)
+    yield from scanners[fmt](d, agency_dict, columns, list(where))
+
+
+def consolidated_formats(d):
+    """d's consolidation manifest: format -> its settings and sources.
+
+    A data.csv consolidated before fd kept a manifest is read as plain csv.
+    """
+    path = d / consolidate_manifest_name
+    if path.exists():
+        with path.open() as f:
+            return json.load(f)
+    if (d / output_name('csv')).exists():
+        return {'csv': {'settings': {}}}
+    return {}
+
+
+def parse_where(condition, agency_dict):
+    """Parse condition as where_condition does, exiting if it can't."""
+    try:
+        return where_condition(condition, agency_dict)
+    except ValueError as e:
+        report(e)
+        sys.exit(1)
+
+
+def where_condition(condition, agency_dict):
+    """Parse condition, such as "year >= 2015" or "area_fips in 01001,01003",
+    into (column, operator, value).
+
+    Values are typed as agency_dict declares column; in and not in take
+    a comma separated list of them.  Raises ValueError if condition can't
+    be understood.
+    """
+    match = re.match(r'\s*(\w+)\s*(==|!=|<=|>=|<|>|=|not in\b|in\b)\s*(.*?)\s*$',
+                     condition)
+    msg = "Can't understand condition {0!r}.".format(condition)
+    if not match or match.group(1) not in agency_dict['dtype']:
+        raise ValueError(msg)
+    k, op, value = match.groups()
+    if op.endswith('in'):
+        value = [v.strip() for v in value.split(',')]
+    else:
+        value = value.strip('\'"')
+    try:
+        return typed_condition((k, op, value), agency_dict)
+    except ValueError:
+        raise ValueError(msg) from None
+
+
+def typed_condition(condition, agency_dict):
+    """Type the value, or for in and not in the values, of condition, a
+    (column, operator, value) triple, as agency_dict declares column.
+
+    Raises ValueError for an unknown column or operator, or a value that
+    isn't of the column's type.
+    """
+    k, op, value = condition
+    if k not in agency_dict['dtype'] or \
+            op not in list(comparisons) + ['in', 'not in']:
+        raise ValueError("Can't understand condition {0!r}.".format(condition))
+    t = agency_dict['dtype'][k]
+    t = t if t in (int, float) else str
+    if op.endswith('in'):
+        if isinstance(value, str):
+            value = value.split(',')
+        return k, op, [t(v) for v in value]
+    return k, op, t(value)
+
+
+def where_mask(chunk, where):
+    """Boolean mask of the rows of chunk meeting every condition in where."""
+    mask = np.ones(len(chunk), dtype=bool)
+    for k, op, value in where:
+        column = chunk[k]
+        if op == 'in':
+            mask &= column.isin(value).to_numpy()
+        elif op == 'not in':
+            mask &= ~column.isin(value).to_numpy()
+        else:
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                column = column.astype(str).where(column.notna())
+            mask &= comparisons[op](column, value).fillna(False).to_numpy(bool)
+    return mask
+
+
+@scanner
+def csv_scan(d, agency_dict, columns, where):
+    """Scan d/data.csv, or its compressed form, in chunks, filtering each
+    as it is read.
+    """
+    compress = consolidated_formats(d)['csv']['settings'].get('compress')
+    dtypes = get_dtypes(agency_dict)
+    args = read_args(agency_dict)
+    if columns:
+        args['usecols'] = set(columns + [k for k, _, _ in where]).__contains__
+    with open_compressed(d / output_name('csv', compress), compress) as f:
+        reader = pd.read_csv(f, iterator=True, **args)
+        for chunk in read_chunks(reader, option('memory_limit')):
+            convert_dtypes(chunk, dtypes)
+            chunk = chunk[where_mask(chunk, where)] if where else chunk
+            yield chunk[columns] if columns else chunk
+
+
+@scanner
+def parquet_scan(d, agency_dict, columns, where):
+    """Scan the Parquet dataset d/data.parquet, pushing the projection and
+    conditions down to the reader: only the columns needed are read, and
+    row groups, and year partitions, the conditions rule out are skipped.
+    """
+    pa, pq = import_pyarrow()
+    import pyarrow.dataset as ds
+    root = d / 'data.parquet'
+    schema = pq.read_schema(str(root / '_common_metadata'))
+    partitioning = None
+    if agency_dict['partition'] == 'year':
+        partitioning = ds.partitioning(pa.schema([schema.field('year')]),
+                                       flavor='hive')
+    dataset = ds.dataset(str(root), schema=schema, format='parquet',
+                         partitioning=partitioning)
+
+    condition = None
+    for k, op, value in where:
+        field = ds.field(k)
+        if pa.types.is_dictionary(schema.field(k).type):
+            field = field.cast(pa.string())
+        if op == 'in':
+            c = field.isin(value)
+        elif op == 'not in':
+            c = ~field.isin(value)
+        else:
+            c = comparisons[op](field, value)
+        condition = c if condition is None else condition & c
+    for batch in dataset.to_batches(columns=columns, filter=condition):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+@scanner
+def sqlite_scan(d, agency_dict, columns, where):
+    """Scan the view data of d/data.sqlite, selecting only the columns
+    needed and the rows meeting the conditions in SQL, where indexes can
+    answer them.
+    """
+    select = ', '.join(sqlite_name(k) for k in columns) if columns else '*'
+    sql = 'SELECT {0} FROM data'.format(select)
+    conditions, params = [], []
+    for k, op, value in where:
+        if op.endswith('in'):
+            c = '{0} {1} ({2})'.format(sqlite_name(k), op.upper(),
+                                       ','.join('?' * len(value)))
+            params += value
+        else:
+            c = '{0} {1} ?'.format(sqlite_name(k), '=' if op == '==' else op)
+            params.append(value)
+        if op in ('!=', 'not in'):
+            # as where_mask: a missing value is unequal to any value
+            c = '({0} OR {1} IS NULL)'.format(c, sqlite_name(k))
+        conditions.append(c)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+
+    dtypes = get_dtypes(agency_dict)
+    uri = (d / 'data.sqlite').resolve().as_uri() + '?mode=ro'
+    con = sqlite3.connect(uri, uri=True)
+    try:
+        cursor = con.execute(sql, params)
+        names = [c[0] for c in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                return
+            chunk = pd.DataFrame.from_records(rows, columns=names)
+            yield convert_dtypes(chunk, dtypes)
+    finally:
+        con.close()
+
+
+@scanner
+def matrix_scan(d, agency_dict, columns, where):
+    """Scan d/data.matrix as rows of series_id, year, period and value,
+    one for each value held.  Only the rows of the series a condition of
+    == or in names are read; other conditions filter the rows unpivoted.
+    """
+    matrix = agency_dict['matrix']
+    names = [matrix['rows']] + matrix['columns'] + [matrix['value']]
+    for k in (columns or []) + [k for k, _, _ in where]:
+        if k not in names:
+            report('{0} matrix has only columns {1}.'.format(
+                d, ', '.join(names)))
+            sys.exit(1)
+    values, series, periods = open_matrix(d)
+    rows = np.arange(len(series))
+    for k, op, value in where:
+        if k == matrix['rows'] and op in ('==', '=', 'in'):
+            keys = value if op == 'in' else [value]
+            rows = np.intersect1d(rows, matrix_rows(series, keys))
+
+    dtypes = get_dtypes(agency_dict)
+    step = max(1, chunk_rows // max(1, len(periods)))
+    for start in range(0, len(rows), step):
+        block = rows[start:start + step]
+        held = values[block]
+        i, j = np.nonzero(~np.isnan(held))
+        chunk = pd.DataFrame({matrix['rows']: series[block][i]})
+        for k in matrix['columns']:
+            chunk[k] = periods[k].to_numpy()[j]
+        chunk[matrix['value']] = held[i, j]
+        convert_dtypes(chunk, dtypes)
+        chunk = chunk[where_mask(chunk, where)] if where else chunk
+        if len(chunk):
+            yield chunk[columns] if columns else chunk
+
+
+# python api
+chunk_readers = {               # agency:dataset -> (schema, chunks(d))
+    'bls:cew': (bls_cew, bls_cew_chunks),
+    'bls:ce': (bls_ce, bls_ce_chunks),
+    'bls:sm': (bls_sm, bls_sm_chunks),
+    'epa:ucmr': (epa_ucmr, epa_ucmr_chunks),
+}
+
+
+def load(ad, columns=None, filters=None, directory=None, frame=False,
+         jobs=1, fips=None, quiet=True):
+    """Load dataset ad, such as 'bls:ce', from its downloaded files.
+
+    The files are read, joined and typed in chunks as the consolidate
+    actions do, but nothing is written: returns a lazy iterator of the
+    DataFrame chunks, or with frame, one DataFrame of them all.
+
+    columns are the columns to select (default: all); filters are
+    conditions rows must meet, as strings such as "year >= 2015" or
+    "area_fips in 01001,01003", or (column, operator, value) triples,
+    whose values are typed as the schema declares the column.
+    directory is the fd directory (default: --directory, else ~/fdata).
+    For bls:cew, jobs and fips, a set of codes or a FILE|LIST, are as
+    consolidate's --jobs and --fips.  Progress is only printed unless
+    quiet.
+
+    Raises ValueError for an unknown dataset, column, filter or fips, and
+    FileNotFoundError if ad has not been downloaded to directory.
+    """
+    if ad not in chunk_readers:
+        raise ValueError("fd doesn't know how to load {0}.".format(ad))
+    agency_dict, chunks = chunk_readers[ad]
+    columns = list(columns) if columns else None
+    for k in columns or []:
+        if k not in agency_dict['dtype']:
+            raise ValueError('{0} has no column {1}.'.format(ad, k))
+    where = [where_condition(f, agency_dict) if isinstance(f, str)
+             else typed_condition(tuple(f), agency_dict)
+             for f in filters or []]
+
+    directory = directory or option('directory', Path.home() / 'fdata')
+    d = Path(directory).joinpath(*ad.split(':'))
+    if not d.is_dir():
+        raise FileNotFoundError('{0} does not exist; download {1} first.'
+                                .format(d, ad))
+    if ad == 'bls:cew':
+        if isinstance(fips, str):
+            fips = fips_codes(fips)
+        elif fips is not None:
+            fips = {str(code).zfill(5) for code in fips}
+        chunks = partial(chunks, jobs=jobs, fips=fips)
+    loaded = load_chunks(chunks(d), columns, where)
+    if quiet:
+        loaded = quietly(loaded)
+    return concat_chunks(loaded) if frame else loaded
+
+
+def quietly(chunks):
+    """Yield each of chunks, made with --quiet in effect."""
+    global args
+    chunks = iter(chunks)
+    while True:
+        saved = args
+        args = argparse.Namespace(**dict(vars(saved), quiet=True))
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            args = saved
+        yield chunk
+
+
+def load_chunks(chunks, columns, where):
+    """Select columns of, and rows meeting where in, each of chunks."""
+    for chunk in chunks:
+        if where:
+            chunk = chunk[where_mask(chunk, where)]
+        yield chunk[columns] if columns else chunk
+
+
+def concat_chunks(chunks):
+    """Concatenate chunks into one DataFrame, keeping categorical columns
+    categorical though each chunk's categories differ.
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    frame = pd.concat(chunks, ignore_index=True)
+    for k, dtype in chunks[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            frame[k] = pd.api.types.union_categoricals(
+                [c[k] for c in chunks])
+    return frame
+
+
+def load_matrix(ad, series=None, directory=None):
+    """Load dataset ad's matrix, written by consolidate --format matrix.
+
+    Returns a DataFrame of value with a row per series_id and a column per
+    (year, period), on the memory-mapped array: nothing is read until it
+    is used.  With series, a list of series_id, only their rows, each
+    found by binary search, are read.  directory is the fd directory
+    (default: --directory, else ~/fdata).
+    """
+    if ad not in chunk_readers or 'matrix' not in chunk_readers[ad][0]:
+        raise ValueError("fd doesn't keep a matrix of {0}.".format(ad))
+    matrix = chunk_readers[ad][0]['matrix']
+    directory = directory or option('directory', Path.home() / 'fdata')
+    d = Path(directory).joinpath(*ad.split(':'))
+    if not (d / 'data.matrix').exists():
+        raise ValueError('{0} has no matrix; consolidate it with --format '
+                         'matrix first.'.format(d))
+    values, ids, periods = open_matrix(d)
+    if series is not None:
+        rows = matrix_rows(ids, list(series))
+        values, ids = values[rows], ids[rows]
+    return pd.DataFrame(
+        values, copy=False,
+        index=pd.Index(ids, name=matrix['rows']),
+        columns=pd.MultiIndex.from_frame(periods[matrix['columns']]))
+
+
+agencies = {'bls': bls,
+            'epa': epa}
+
+
+# cli: program
+
+def available(args):
+    """Print available agencies or their datasets."""
+    ag = args.agency
+    if ag:
         if ag in agencies:
             print('{0} has available datasets:'.format(ag.upper()))
 
@@ -862,9 +3435,6 @@ def available(args):
         print(''.join(msg).format(', '.join(agencies.keys()).upper()))
 
 
-parser_available.set_defaults(func=available)
-
-
 # cli dispatch
 def dispatch(args):
     """Dispatch user supplied action/agency to appropriate function."""
@@ -873,32 +3443,21 @@ def dispatch(args):
         'a': 'available',
         'c': 'consolidate',
         'd': 'download',
+        'f': 'fetch',
+        'q': 'query',
+        'u': 'update',
     }
     action = aliases[args.action] if len(args.action)==1 else args.action
     act = '_'.join(args.ad.split(':') + [action])
     if act in actions:
-        actions[act](args.directory)
+        with metrics_report(option('metrics'), act):
+            actions[act](args.directory)
     else:
         # TODO add more helpful fail; not understand the dataset or agency?
         msg = "fd doesn't understand how to {0} {1}."
         print(msg.format(action, args.ad))
 
 
-# cli download
-
-parser_download = subparser.add_parser(
-    'download',
-    aliases='d',
-    description="Download specified agency's dataset.",
-    help="download agency's dataset",
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog="""example:
-
-  $ fd download bls:cew
-    """
-)
-
-
 def get_choices():
     """Get allowable choices of agency:dataset combinations."""
     choices = []
@@ -908,105 +3467,512 @@ def get_choices():
     return choices
 
 
-parser_download.add_argument(
-    'ad',
-    help='agency and dataset of interest, abbreviations only',
-    choices=get_choices(),
-    metavar='agency:dataset',
-    nargs='?',
-    type=str.lower,
-    default=None
-)
+def help_message(subparser, args):
+    """Print helpful message relative to the specified action."""
+    act = args.action
+    if act:
+        if act in [x for x in subparser.choices.keys() if len(x) > 1]:
+            subparser.choices[str(act)].print_help()
+        else:
+            print('Unknown action.')
+    else:
+        print('Must specify an action.')
+
+
+def build_parser():
+    """Build the command line parser.
+
+    Built only when fd runs as a program, not whenever it is imported.
+    """
+    parser = argparse.ArgumentParser(
+        prog='fd',
+        description='Provide analysis ready US federal data.'
+    )
+
+    parser.add_argument(
+        '-d',
+        '--directory',
+        default=Path.home() / 'fdata',
+        type=Path,
+        help='set directory for fd to use'
+    )
+
+    parser.add_argument(
+        '-q',
+        '--quiet',
+        action='store_true',
+        help='do not print status along the way'
+    )
+
+    parser.add_argument(
+        '--cache',
+        default=os.environ.get('FD_CACHE'),
+        type=Path,
+        metavar='DIR',
+        help=('download cache shared between directories; files in it are '
+              'hardlinked into place (default: $FD_CACHE, else none)')
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        dest='cache',
+        action='store_const',
+        const=None,
+        help='neither use nor fill the download cache'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        default='20G',
+        type=parse_size,
+        metavar='SIZE',
+        help=('bytes the download cache may hold before the least recently '
+              'used files are dropped (default: %(default)s)')
+    )
+
+    parser.add_argument(
+        '--catalog-ttl',
+        default=24.0,
+        type=float,
+        metavar='HOURS',
+        help="hours before the catalog of datasets' URLs is refreshed (default: %(default)s)"
+    )
+
+    parser.add_argument(
+        '--metrics',
+        metavar='PATH',
+        help='write the time, CPU, rows, bytes and peak RSS of each stage, as JSON'
+    )
+
+    parser.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='sample the stacks of the run, as folded stacks for flame graphs'
+    )
+
+    parser.add_argument(
+        '--profile-interval',
+        default=5.0,
+        type=float,
+        metavar='MS',
+        help='milliseconds between stack samples (default: %(default)s)'
+    )
+
+    catalog_mode = parser.add_mutually_exclusive_group()
+
+    catalog_mode.add_argument(
+        '--refresh',
+        action='store_true',
+        help="refresh the catalog of datasets' URLs, however recent"
+    )
+
+    catalog_mode.add_argument(
+        '--offline',
+        action='store_true',
+        help="use only the catalog of datasets' URLs, however old"
+    )
+
+    parser.add_argument(
+        '-v',
+        '--version',
+        action='version',
+        version='%(prog)s v0.1'
+    )
+
+    # cli: actions
+
+    subparser = parser.add_subparsers(
+        help='actions to perform on federal agencies',
+        metavar='action',
+        dest='action'
+    )
+
+    # cli available
+
+    parser_available = subparser.add_parser(
+        'available',
+        aliases='a',
+        description=("Print available agencies "
+                     "or available datasets relative to a specified agency."),
+        help="list available agencies or an agency's datasets",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""examples:
 
-parser_download.set_defaults(func=dispatch)
+  $ fd available
+
+  $ fd available bls
+    """
+    )
+
+    parser_available.add_argument(
+        'agency',
+        help='list datasets from specified agency',
+        metavar='agency',
+        type=str.lower,
+        nargs='?',
+        default=None
+    )
+
+    parser_available.set_defaults(func=available)
+
+    # cli cache
+
+    parser_cache = subparser.add_parser(
+        'cache',
+        description=("Print the files in the download cache, most recently "
+                     "used first, or prune it."),
+        help='inspect or prune the download cache',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""examples:
+
+  $ fd --cache /srv/fd-cache cache
+
+  $ fd --cache-size 5G cache --prune
+    """
+    )
+
+    cache_prune = parser_cache.add_mutually_exclusive_group()
+
+    cache_prune.add_argument(
+        '--prune',
+        action='store_true',
+        help='drop the least recently used files beyond --cache-size'
+    )
+
+    cache_prune.add_argument(
+        '--clear',
+        action='store_true',
+        help='drop every file'
+    )
+
+    parser_cache.set_defaults(func=cache)
+
+    # cli download
+
+    transfer_options = argparse.ArgumentParser(add_help=False)
+
+    transfer_options.add_argument(
+        '-w',
+        '--workers',
+        default=8,
+        type=int,
+        help='number of files to download at once (default: %(default)s)'
+    )
+
+    transfer_options.add_argument(
+        '--per-host',
+        default=4,
+        type=int,
+        help='maximum connections open to any one host (default: %(default)s)'
+    )
+
+    transfer_options.add_argument(
+        '--retries',
+        default=5,
+        type=int,
+        help='times to retry, and resume, a failed transfer (default: %(default)s)'
+    )
+
+    transfer_options.add_argument(
+        '--buffer-size',
+        default='1M',
+        type=parse_size,
+        help='bytes read from the network at a time (default: %(default)s)'
+    )
+
+    parser_download = subparser.add_parser(
+        'download',
+        aliases='d',
+        parents=[transfer_options],
+        description="Download specified agency's dataset.",
+        help="download agency's dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""example:
+
+  $ fd download bls:cew
+    """
+    )
+
+    parser_download.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
 
+    parser_download.set_defaults(func=dispatch)
 
-# cli consolidate
+    # cli consolidate
 
-parser_consolidate = subparser.add_parser(
-    'consolidate',
-    aliases='c',
-    description="Consolidate specified agency's downloaded dataset.",
-    help="consolidate agency's dataset",
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog="""example:
+    memory_options = argparse.ArgumentParser(add_help=False)
+
+    memory_options.add_argument(
+        '--memory-limit',
+        type=parse_size,
+        metavar='SIZE',
+        help=('bytes of memory, such as 512M or 8G, to size the chunks read to; '
+              'larger limits read larger chunks (default: chunks of {0:,} rows)'
+              .format(chunk_rows))
+    )
+
+    consolidate_options = argparse.ArgumentParser(add_help=False,
+                                                  parents=[memory_options])
+
+    consolidate_options.add_argument(
+        '-f',
+        '--format',
+        default='csv',
+        choices=sorted(outputs),
+        help='format of the consolidated data (default: %(default)s)'
+    )
+
+    consolidate_options.add_argument(
+        '-j',
+        '--jobs',
+        default=1,
+        type=int,
+        help='processes used to parse archives, bls:cew only (default: %(default)s)'
+    )
+
+    consolidate_options.add_argument(
+        '-o',
+        '--output',
+        metavar='PATH',
+        help=("stream the consolidated data, as CSV, to PATH, or to stdout "
+              "with -, instead of writing it to the dataset's directory")
+    )
+
+    consolidate_options.add_argument(
+        '--compress',
+        choices=sorted(compressions),
+        help='compress csv output, as data.csv.gz, .bz2 or .zst (default: none)'
+    )
+
+    consolidate_options.add_argument(
+        '--rollup',
+        action='append',
+        metavar='KEYS',
+        help=('also total wages, establishments and employment by KEYS, such as '
+              'year,state or year,qtr,own_code, into rollups/KEYS.csv, bls:cew '
+              'only; may be repeated')
+    )
+
+    consolidate_options.add_argument(
+        '--fips',
+        metavar='FILE|LIST',
+        help=('keep only these areas, bls:cew only: a comma separated list of '
+              'FIPS codes or a file of them, one per line or in a fips column')
+    )
+
+    parser_consolidate = subparser.add_parser(
+        'consolidate',
+        aliases='c',
+        parents=[consolidate_options],
+        description="Consolidate specified agency's downloaded dataset.",
+        help="consolidate agency's dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""examples:
 
   $ fd consolidate bls:cew
+
+  $ fd consolidate bls:ce -o - | psql -c 'COPY ce FROM STDIN CSV HEADER'
     """
-)
+    )
+
+    parser_consolidate.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
+
+    parser_consolidate.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='consolidate every source again, even those unchanged since last time'
+    )
+
+    parser_consolidate.set_defaults(func=dispatch)
+
+    # cli fetch
+
+    parser_fetch = subparser.add_parser(
+        'fetch',
+        aliases='f',
+        parents=[transfer_options, consolidate_options],
+        description=("Download and consolidate specified agency's dataset, "
+                     "consolidating files as they finish downloading."),
+        help="download and consolidate agency's dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""example:
+
+  $ fd fetch bls:cew
+    """
+    )
+
+    parser_fetch.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
+
+    parser_fetch.set_defaults(func=dispatch)
+
+    # cli query
+
+    parser_query = subparser.add_parser(
+        'query',
+        aliases='q',
+        parents=[memory_options],
+        description=("Select columns and rows of specified agency's consolidated "
+                     "dataset, reading only what the selection needs."),
+        help="query agency's consolidated dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""example:
+
+  $ fd query bls:cew -c area_fips year qtr total_qtrly_wages \\
+        -w 'area_fips in 01001,01003' -w 'year >= 2015' -o wages.csv
+    """
+    )
+
+    parser_query.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
+
+    parser_query.add_argument(
+        '-c',
+        '--columns',
+        nargs='+',
+        action='extend',
+        help='columns to select (default: all)'
+    )
+
+    parser_query.add_argument(
+        '-w',
+        '--where',
+        action='append',
+        metavar='CONDITION',
+        help=('condition rows must meet, such as "year >= 2015" or '
+              '"area_fips in 01001,01003"; may be repeated')
+    )
 
-parser_consolidate.add_argument(
-    'ad',
-    help='agency and dataset of interest, abbreviations only',
-    choices=get_choices(),
-    metavar='agency:dataset',
-    nargs='?',
-    type=str.lower,
-    default=None
-)
+    parser_query.add_argument(
+        '-f',
+        '--format',
+        choices=sorted(scanners),
+        help='consolidated format to read (default: the best one consolidated)'
+    )
+
+    parser_query.add_argument(
+        '-o',
+        '--output',
+        default='-',
+        help='file to write the selected rows to, as CSV (default: stdout)'
+    )
 
-parser_consolidate.set_defaults(func=dispatch)
+    parser_query.set_defaults(func=dispatch)
 
-# cli detail
+    # cli detail
 
-parser_detail = subparser.add_parser(
-    'detail',
-    description="Detail information about specified agency's dataset.",
-    help="detail info about specified agency's dataset",
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog="""examples:
+    parser_detail = subparser.add_parser(
+        'detail',
+        description="Detail information about specified agency's dataset.",
+        help="detail info about specified agency's dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""examples:
 
   $ fd detail bls:cew
     """
-)
-
-parser_detail.add_argument(
-    'ad',
-    help='agency and dataset of interest, abbreviations only',
-    choices=get_choices(),
-    metavar='agency:dataset',
-    nargs='?',
-    type=str.lower,
-    default=None
-)
-
-parser_detail.set_defaults(func=dispatch)
-
-# cli help
-
-parser_help = subparser.add_parser(
-    'help',
-    aliases='h',
-    description='Provide help message for the specified action.',
-    help='provide helpful information about specified action',
-    formatter_class=argparse.RawDescriptionHelpFormatter
-)
-
-parser_help.add_argument(
-    'action',
-    help='action about which a helpful message is desired',
-    choices=[x for x in subparser.choices.keys() if len(x) > 1],
-    metavar='action',
-    type=str.lower,
-    default=None
-)
-
-
-def help_message(args):
-    """Print helpful message relative to the specified action."""
-    act = args.action
-    if act:
-        if act in [x for x in subparser.choices.keys() if len(x) > 1]:
-            subparser.choices[str(act)].print_help()
-        else:
-            print('Unknown action.')
-    else:
-        print('Must specify an action.')
+    )
+
+    parser_detail.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
+
+    parser_detail.set_defaults(func=dispatch)
+
+    # cli update
+
+    parser_update = subparser.add_parser(
+        'update',
+        aliases='u',
+        parents=[transfer_options],
+        description=("Re-download only the files of a specified agency's dataset "
+                     "that changed since they were last downloaded."),
+        help="refresh agency's downloaded dataset",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""example:
+
+  $ fd update bls:ce
+    """
+    )
+
+    parser_update.add_argument(
+        'ad',
+        help='agency and dataset of interest, abbreviations only',
+        choices=get_choices(),
+        metavar='agency:dataset',
+        nargs='?',
+        type=str.lower,
+        default=None
+    )
+
+    parser_update.set_defaults(func=dispatch)
+
+    # cli help
+
+    parser_help = subparser.add_parser(
+        'help',
+        aliases='h',
+        description='Provide help message for the specified action.',
+        help='provide helpful information about specified action',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser_help.add_argument(
+        'action',
+        help='action about which a helpful message is desired',
+        choices=[x for x in subparser.choices.keys() if len(x) > 1],
+        metavar='action',
+        type=str.lower,
+        default=None
+    )
+
+    parser_help.set_defaults(func=partial(help_message, subparser))
+
+    return parser
 
-parser_help.set_defaults(func=help_message)
 
 # main program
 def main():
     global args
-    args = parser.parse_args()
-    sys.exit(args.func(args))
+    args = build_parser().parse_args()
+    try:
+        sys.exit(args.func(args))
+    except BrokenPipeError:
+        # stdout's reader, such as head, stopped early: stop quietly, with
+        # stdout on devnull so flushing it at exit raises nothing more
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -10,6 +10,10 @@ setup(
         'requests',
         'pytest',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': ['fd=fd:main'],
     },
@@ -0,0 +1,97 @@
+import argparse
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import fd
+from synthetic import make_fddir
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    fd.args = argparse.Namespace(quiet=True)
+    fd.sessions.clear()
+    yield
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve server.files, tracking how many requests are in flight."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            body = server.files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            time.sleep(server.delay)
+            if server.failures:
+                server.failures -= 1
+                self.send_error(503)
+                return
+            etag = '"{0:x}"'.format(zlib.crc32(body))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            start = 0
+            rng = self.headers.get('Range')
+            if self.headers.get('If-Range', etag) != etag:
+                rng = None          # changed since: send all of it
+            if rng:
+                start = int(rng.split('=')[1].rstrip('-'))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    start, len(body) - 1, len(body)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body) - start))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            server.ranges.append(start)
+            if server.drops:
+                # advertise the full length, then hang up partway through
+                server.drops -= 1
+                self.wfile.write(body[start:start + server.drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body[start:])
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *pargs):
+        pass
+
+
+@pytest.fixture
+def server():
+    """Local HTTP stand-in for the agencies' file servers."""
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files = {}
+    httpd.delay = 0.0
+    httpd.failures = 0              # requests answered with a 503
+    httpd.drops = 0                 # responses cut off after drop_after bytes
+    httpd.drop_after = 0
+    httpd.ranges = []               # starting offset of each response
+    httpd.lock = threading.Lock()
+    httpd.active = 0
+    httpd.max_active = 0
+    httpd.url = 'http://127.0.0.1:{0}'.format(httpd.server_port)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def fddir(tmp_path):
+    """An fd directory holding small downloads of every dataset."""
+    return make_fddir(tmp_path)
@@ -0,0 +1,259 @@
+"""Synthetic copies of the agencies' files.
+
+Each make_* function writes a dataset directory laid out like fd's
+downloads, with the same file names, archive members, headers, quoting
+and missing value markers as the real files.  Row counts are parameters,
+so the same builders serve the tests, with a few hundred rows, and the
+benchmarks, with millions; rows are generated column-wise with numpy.
+"""
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import fd
+
+
+def write_table(path, header, rows, sep='\t'):
+    lines = [sep.join(header)] if header else []
+    lines += [sep.join(str(v) for v in row) for row in rows]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def pick(values, index):
+    """values[index], for a list of values and an array of indexes."""
+    return np.asarray(values, dtype=object)[index]
+
+
+def amounts(i):
+    """Nonnegative amounts with two decimals, varying with row index i."""
+    return (i * 37 % 1000) * 1.5
+
+
+cew_areas = [('US000', 'U.S. TOTAL'), ('06000', 'California -- Statewide'),
+             ('06001', 'Alameda County, California'),
+             ('41051', 'Multnomah County, Oregon')]
+
+
+def cew_area_list(nareas):
+    """The first nareas areas: cew_areas, then made up counties."""
+    areas = cew_areas[:nareas]
+    for k in range(len(areas), nareas):
+        fips = '{0:02d}{1:03d}'.format(1 + k // 200 % 56, 1 + 2 * (k % 200))
+        areas.append((fips, 'County {0}, State {1}'.format(k, k // 200 % 56)))
+    return areas
+
+
+def cew_csv(year, n, nareas=4):
+    """Text of a CEW all industries CSV with n rows of year."""
+    i = np.arange(n)
+    fips, titles = zip(*cew_area_list(nareas))
+    columns = []
+    for k, v in fd.bls_cew['dtype'].items():
+        if k == 'area_fips':
+            column = pick(fips, i % nareas)
+        elif k == 'area_title':
+            column = pick(titles, i % nareas)
+        elif k == 'year':
+            column = np.full(n, year)
+        elif k == 'qtr':
+            column = i % 4 + 1
+        elif k in ('own_code', 'size_code'):
+            column = i % 2
+        elif k == 'industry_code':
+            column = np.full(n, 10)
+        elif k == 'agglvl_code':
+            column = 70 + i % 3
+        elif k.endswith('disclosure_code'):
+            column = np.where(i % 5, '', 'N')
+        elif v == str:
+            column = np.full(n, k.replace('_', ' ').title())
+        elif v == 'category':
+            title = k.replace('_', ' ').title()
+            column = pick([title + ' ' + str(j) for j in range(3)], i % 3)
+        else:
+            column = amounts(i)
+        columns.append(column)
+    # the real files name two columns oty_taxable_qtrly_wages_chg
+    header = [k if k != 'oty_taxable_qtrly_wages_pct'
+              else 'oty_taxable_qtrly_wages_chg'
+              for k in fd.bls_cew['dtype']]
+    table = pd.DataFrame(dict(enumerate(columns)))
+    table.columns = header
+    return table.to_csv(index=False, float_format='%.2f')
+
+
+def make_bls_cew(d, years=(2015, 2016), n=50, nareas=4):
+    """Write a bls:cew directory, one archive of n rows per year."""
+    d.mkdir(parents=True, exist_ok=True)
+    for year in years:
+        name = '{0}_qtrly_by_industry.zip'.format(year)
+        with zipfile.ZipFile(str(d / name), 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('{0}.q1-q4.by_industry/{0}.q1-q4 10 Total, all '
+                       'industries.csv'.format(year), cew_csv(year, n, nareas))
+            z.writestr('{0}.q1-q4.by_industry/{0}.q1-q4 1011 Natural '
+                       'resources and mining.csv'.format(year), cew_csv(year, 3))
+    return d
+
+
+bls_data_names = {'ce': '0.AllCESSeries', 'sm': '1.AllData'}
+
+
+def make_bls_time_series(d, prefix, n=200, nseries=7):
+    """Write a bls:ce (prefix 'ce') or bls:sm (prefix 'sm') directory
+    whose data file holds n observations of nseries series.
+    """
+    d.mkdir(parents=True, exist_ok=True)
+    ids = ['{0}{1}{2:011d}'.format(prefix.upper(), 'S' if i % 2 else 'U', i)
+           for i in range(nseries)]
+    periods = ['M{0:02d}'.format(m) for m in range(1, 14)]
+    i = np.arange(n)
+    values = np.char.mod('%.1f', i * 3.7).astype(object)
+    if prefix == 'sm':
+        values[i % 17 == 0] = '-'
+    data = pd.DataFrame({
+        'series_id': pick(ids, i % nseries),
+        'year': 2000 + i // (nseries * 13),
+        'period': pick(periods, i // nseries % 13),
+        'value': values,
+        'footnote_codes': np.where(i % 11, '', 'P'),
+    })
+    data.to_csv(d / '{0}.data.{1}'.format(prefix, bls_data_names[prefix]),
+                sep='\t', index=False)
+
+    end_year = 2000 + (n - 1) // (nseries * 13)
+    if prefix == 'ce':
+        write_table(d / 'ce.series',
+                    ['series_id', 'supersector_code', 'industry_code',
+                     'data_type_code', 'seasonal', 'series_title',
+                     'footnote_codes', 'begin_year', 'begin_period',
+                     'end_year', 'end_period'],
+                    [(s, '{0:02d}'.format(i % 3), '{0:08d}'.format(i % 4),
+                      '{0:02d}'.format(i % 2 + 1), s[2], 'Series {0}'.format(i),
+                      '', 2000, 'M01', end_year, 'M13')
+                     for i, s in enumerate(ids)])
+        write_table(d / 'ce.datatype', ['data_type_code', 'data_type_text'],
+                    [('01', 'ALL EMPLOYEES'), ('02', 'AVERAGE WEEKLY HOURS')])
+        write_table(d / 'ce.industry',
+                    ['industry_code', 'naics_code', 'publishing_status',
+                     'industry_name', 'display_level', 'selectable',
+                     'sort_sequence'],
+                    [('{0:08d}'.format(i), '-', 'A', 'Industry {0}'.format(i),
+                      i, 'T', i + 1) for i in range(4)])
+        write_table(d / 'ce.seasonal', ['seasonal_code', 'seasonal_text'],
+                    [('S', 'Seasonally Adjusted'), ('U', 'Not Seasonally Adjusted')])
+        write_table(d / 'ce.supersector', ['supersector_code', 'supersector_name'],
+                    [('{0:02d}'.format(i), 'Supersector {0}'.format(i))
+                     for i in range(3)])
+        write_table(d / 'ce.period', None,
+                    [(p, 'M{0}'.format(i), 'Month {0}'.format(i))
+                     for i, p in enumerate(periods, 1)])
+    else:
+        write_table(d / 'sm.series',
+                    ['series_id', 'state_code', 'area_code', 'supersector_code',
+                     'industry_code', 'data_type_code', 'seasonal',
+                     'benchmark_year', 'footnote_codes', 'begin_year',
+                     'begin_period', 'end_year', 'end_period'],
+                    [(s, '{0:02d}'.format(i % 2 + 1), '{0:05d}'.format(i % 3),
+                      '{0:02d}'.format(i % 3), '{0:08d}'.format(i % 4),
+                      '{0:02d}'.format(i % 2 + 1), s[2], 2016, '',
+                      2000, 'M01', end_year, 'M13')
+                     for i, s in enumerate(ids)])
+        write_table(d / 'sm.area', ['area_code', 'area_name'],
+                    [('{0:05d}'.format(i), 'Area {0}'.format(i)) for i in range(3)])
+        write_table(d / 'sm.data_type', ['data_type_code', 'data_type_text'],
+                    [('01', 'All Employees'), ('02', 'Average Weekly Hours')])
+        write_table(d / 'sm.industry', ['industry_code', 'industry_name'],
+                    [('{0:08d}'.format(i), 'Industry {0}'.format(i))
+                     for i in range(4)])
+        write_table(d / 'sm.state', ['state_code', 'state_name'],
+                    [('01', 'Alabama'), ('02', 'Alaska')])
+        write_table(d / 'sm.supersector', ['supersector_code', 'supersector_name'],
+                    [('{0:02d}'.format(i), 'Supersector {0}'.format(i))
+                     for i in range(3)])
+    return d
+
+
+ucmr_columns = ['PWSID', 'PWSName', 'Size', 'FacilityID', 'FacilityName',
+                'FacilityWaterType', 'SamplePointID', 'SamplePointName',
+                'SamplePointType', 'AssociatedFacilityID',
+                'AssociatedSamplePointID', 'CollectionDate', 'SampleID',
+                'Contaminant', 'MRL', 'MethodID', 'AnalyticalResultsSign',
+                'AnalyticalResultValue', 'SampleEventCode',
+                'MonitoringRequirement', 'Region', 'State']
+
+
+def ucmr_rows(n, year, columns):
+    """n occurrence rows of year, as a DataFrame of strings in columns."""
+    i = np.arange(n)
+    known = {
+        'PWSID': lambda: np.char.mod('AL%07d', i % 9),
+        'FacilityID': lambda: (i % 3).astype(str),
+        'SamplePointID': lambda: np.char.mod('SP%d', i % 2),
+        'CollectionDate': lambda: np.char.add(
+            np.char.mod(str(year) + '-0%d-1', i % 9 + 1), (i % 10).astype(str)),
+        'Contaminant': lambda: pick(['1,4-dioxane', 'chromium', 'strontium'],
+                                    i % 3),
+        'MRL': lambda: np.full(n, '0.07'),
+        'AnalyticalResultsSign': lambda: np.where(i % 4, '<', '='),
+        'AnalyticalResultValue': lambda: np.where(
+            i % 4, '', np.char.mod('%.3f', i / 7)),
+        'SampleEventCode': lambda: np.char.mod('SE%d', i % 4 + 1),
+        'DisinfectantType': lambda: np.full(n, 'CLGA'),
+        'State': lambda: pick(['AL', 'CA', 'OR'], i % 3),
+    }
+    return pd.DataFrame({
+        c: known[c]() if c in known else np.char.mod(c[:3].upper() + '%d', i % 5)
+        for c in columns
+    }, columns=columns)
+
+
+def make_epa_ucmr(d, n=120):
+    """Write an epa:ucmr directory: n UCMR 3 rows and n/2 UCMR 2 rows."""
+    d.mkdir(parents=True, exist_ok=True)
+
+    def text(table):
+        return table.to_csv(sep='\t', index=False)
+
+    drt = pd.DataFrame(
+        [['AL{0:07d}'.format(i), str(f), 'SP{0}'.format(p), 'SE1',
+          '2013-0{0}-1{1}'.format(i % 9 + 1, i % 10), 'CLGA']
+         for i in range(9) for f in range(3) for p in range(2)],
+        columns=['PWSID', 'FacilityID', 'SamplePointID', 'SampleEventCode',
+                 'CollectionDate', 'Disinfectant Type'])
+    zipcodes = pd.DataFrame(
+        [['AL{0:07d}'.format(i), '{0:05d}'.format(35000 + i)] for i in range(8)],
+        columns=['PWSID', 'ZIPCODE'])
+    with zipfile.ZipFile(str(d / 'ucmr-3-occurrence-data.zip'), 'w',
+                         zipfile.ZIP_DEFLATED) as z:
+        z.writestr('UCMR3_All.txt', text(ucmr_rows(n, 2013, ucmr_columns)))
+        z.writestr('UCMR3_DRT.txt', text(drt))
+        z.writestr('UCMR3_ZipCodes.txt', text(zipcodes))
+    columns2 = ucmr_columns[:11] + ['DisinfectantType'] + ucmr_columns[11:]
+    with zipfile.ZipFile(str(d / 'ucmr2_occurrencedata_jan12.zip'), 'w',
+                         zipfile.ZIP_DEFLATED) as z:
+        z.writestr('UCMR2_All_OccurrenceData_Jan12.txt',
+                   text(ucmr_rows(n // 2, 2009, columns2)))
+    return d
+
+
+def make_fddir(root, rows=None):
+    """Write every dataset under the fd directory root.
+
+    rows, if given, sets roughly how many data rows each dataset holds;
+    otherwise the datasets are small enough for the tests.
+    """
+    if rows is None:
+        make_bls_cew(root / 'bls/cew')
+        make_bls_time_series(root / 'bls/ce', 'ce')
+        make_bls_time_series(root / 'bls/sm', 'sm')
+        make_epa_ucmr(root / 'epa/ucmr')
+        return root
+    make_bls_cew(root / 'bls/cew', years=(2014, 2015, 2016, 2017),
+                 n=rows // 4, nareas=3200)
+    make_bls_time_series(root / 'bls/ce', 'ce', n=rows,
+                         nseries=max(7, rows // 500))
+    make_bls_time_series(root / 'bls/sm', 'sm', n=rows,
+                         nseries=max(7, rows // 500))
+    make_epa_ucmr(root / 'epa/ucmr', n=rows * 2 // 3)
+    return root
@@ -1,5 +1,16 @@
+import io
+import sys
+import time
+import argparse
+import zipfile
+import sqlite3
+import subprocess
+from contextlib import closing
 import pytest
+import numpy as np
+import pandas as pd
 import fd
+from synthetic import make_bls_cew, make_epa_ucmr, make_fddir
 import requests as r
 
 
@@ -13,10 +24,876 @@ def test_bls_cew_download():
         assert downloadable(r.head(url))
 
 
-def test_bls_cew_consolidate():
-    assert False
+def test_bls_cew_consolidate(fddir):
+    d = consolidate(fddir, 'bls:cew')
+    data = pd.read_csv(d / 'data.csv', dtype=str)
+    # only the all industries CSVs, 50 rows a year
+    assert len(data) == 100
+    assert list(data.columns) == list(fd.bls_cew['dtype'])
+    assert data.year.value_counts().to_dict() == {'2015': 50, '2016': 50}
 
 
 def test_blw_ce_download():
-    for url in fd.bls_ce['data_urls']:
-        assert downloadable(r.head(fd.bls_ce['webpage']+url))
+    for url in fd.get_bls_ce_urls():
+        assert downloadable(r.head(url))
+
+
+def test_download_urls_concurrent(server, tmp_path):
+    fd.args.per_host = 2
+    server.delay = 0.1
+    for i in range(6):
+        server.files['/f{0}.txt'.format(i)] = str(i).encode() * 5000
+    urls = [server.url + name for name in server.files]
+    paths = fd.download_urls(urls, tmp_path)
+    assert sorted(p.name for p in paths) == ['f{0}.txt'.format(i) for i in range(6)]
+    assert (tmp_path / 'f3.txt').read_bytes() == b'3' * 5000
+    assert 1 < server.max_active <= 2
+    assert len(fd.sessions) == 1
+
+
+def test_copy_url_resumes_dropped_connections(server, tmp_path):
+    fd.args.backoff = 0
+    fd.args.buffer_size = 4096
+    body = bytes(range(256)) * 4000
+    server.files['/big.bin'] = body
+    server.failures = 1
+    server.drops = 2
+    server.drop_after = 300000
+    path = fd.copy_url(server.url + '/big.bin', tmp_path)
+    assert path.read_bytes() == body
+    # first request plus one resumed Range request per dropped connection
+    assert len(server.ranges) == 3
+    assert 0 == server.ranges[0] < server.ranges[1] < server.ranges[2]
+    assert not (tmp_path / 'big.bin.part').exists()
+
+
+def test_copy_url_restarts_parts_of_changed_files(server, tmp_path):
+    fd.args.backoff = 0
+    fd.args.retries = 0
+    fd.args.buffer_size = 100
+    server.files['/f.bin'] = b'A' * 1000
+    server.drops = 1
+    server.drop_after = 400
+    with pytest.raises((fd.IncompleteDownload, r.RequestException)):
+        fd.copy_url(server.url + '/f.bin', tmp_path)
+    assert (tmp_path / 'f.bin.part').read_bytes() == b'A' * 400
+
+    # the part of the old file is started over, not resumed
+    server.files['/f.bin'] = b'B' * 1000
+    path = fd.copy_url(server.url + '/f.bin', tmp_path)
+    assert path.read_bytes() == b'B' * 1000
+    assert server.ranges == [0, 0]
+    assert fd.read_manifest(tmp_path)['f.bin']['size'] == 1000
+    assert not (tmp_path / 'f.bin.part').exists()
+    assert not (tmp_path / 'f.bin.part.json').exists()
+
+    # unchanged, it is resumed; without saved validators, started over
+    server.drops = 1
+    with pytest.raises((fd.IncompleteDownload, r.RequestException)):
+        fd.copy_url(server.url + '/f.bin', tmp_path)
+    assert fd.copy_url(server.url + '/f.bin', tmp_path).read_bytes() \
+        == b'B' * 1000
+    assert server.ranges[2:] == [0, 400]
+    (tmp_path / 'f.bin.part').write_bytes(b'A' * 400)
+    assert fd.copy_url(server.url + '/f.bin', tmp_path).read_bytes() \
+        == b'B' * 1000
+    assert server.ranges[4:] == [0]
+
+
+def test_copy_url_gives_up(server, tmp_path):
+    fd.args.backoff = 0
+    fd.args.retries = 2
+    server.files['/f.txt'] = b'x'
+    server.failures = 3
+    with pytest.raises(fd.IncompleteDownload):
+        fd.copy_url(server.url + '/f.txt', tmp_path)
+    assert not (tmp_path / 'f.txt').exists()
+
+
+def test_update_transfers_only_changed_files(server, tmp_path):
+    for name in ['a', 'b', 'c']:
+        server.files['/' + name] = name.encode() * 100
+    urls = [server.url + '/' + name for name in ['a', 'b', 'c']]
+    assert len(fd.download_urls(urls, tmp_path)) == 3
+    manifest = fd.read_manifest(tmp_path)
+    assert manifest['a']['size'] == 100 and manifest['a']['etag']
+
+    server.files['/b'] = b'changed'
+    changed = fd.download_urls(urls, tmp_path, update=True)
+    assert [p.name for p in changed] == ['b']
+    assert (tmp_path / 'b').read_bytes() == b'changed'
+    assert fd.read_manifest(tmp_path)['b']['size'] == 7
+
+    # a local file that no longer matches its manifest entry is re-fetched
+    (tmp_path / 'c').write_bytes(b'truncated')
+    assert [p.name for p in fd.download_urls(urls, tmp_path, update=True)] == ['c']
+
+
+def test_cache_links_unchanged_files_across_directories(server, tmp_path,
+                                                       capsys):
+    fd.args = argparse.Namespace(quiet=True, cache=tmp_path / 'cache',
+                                 cache_size=25000)
+    for name in ['a', 'b', 'c']:
+        server.files['/' + name] = name.encode() * 10000
+    urls = [server.url + '/' + name for name in ['a', 'b']]
+    one, two = tmp_path / 'one', tmp_path / 'two'
+    one.mkdir()
+    two.mkdir()
+    fd.download_urls(urls, one)
+    assert len(server.ranges) == 2
+
+    # the other directory gets links to the cached files, not transfers
+    assert len(fd.download_urls(urls, two)) == 2
+    assert len(server.ranges) == 2
+    assert (two / 'a').read_bytes() == b'a' * 10000
+    assert (two / 'a').stat().st_ino == (one / 'a').stat().st_ino
+    assert fd.read_manifest(two)['a']['etag']
+
+    # a changed file is downloaded again, and a damaged object refetched
+    server.files['/b'] = b'B' * 10000
+    (tmp_path / 'three').mkdir()
+    with (one / 'a').open('r+b') as f:
+        f.write(b'x')
+    fd.download_urls(urls, tmp_path / 'three')
+    assert len(server.ranges) == 4
+    assert (tmp_path / 'three/a').read_bytes() == b'a' * 10000
+    assert (tmp_path / 'three/b').read_bytes() == b'B' * 10000
+
+    # past 25000 bytes the least recently used file, b, is evicted
+    fd.copy_url(server.url + '/a', two)
+    fd.copy_url(server.url + '/c', two)
+    index = fd.read_manifest(tmp_path / 'cache', fd.cache_index_name)
+    assert sorted(index) == [server.url + '/a', server.url + '/c']
+    assert len(list((tmp_path / 'cache/objects').glob('*/*'))) == 2
+
+    fd.cache(argparse.Namespace(prune=False, clear=True))
+    assert fd.read_manifest(tmp_path / 'cache', fd.cache_index_name) == {}
+    assert 'Dropped 2 files' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(fd.fcntl is None, reason='needs flock')
+def test_cache_index_keeps_concurrent_processes_updates(tmp_path):
+    script = (
+        'import sys, argparse, fd\n'
+        'fd.args = argparse.Namespace(quiet=True, cache=sys.argv[1])\n'
+        'd = fd.Path(sys.argv[1]).parent / sys.argv[2]\n'
+        'd.mkdir()\n'
+        'for i in range(20):\n'
+        '    path = d / str(i)\n'
+        '    path.write_text(sys.argv[2] + str(i))\n'
+        '    fd.cache_store(path, fd.download_entry(\n'
+        '        "http://x/" + sys.argv[2] + str(i), {"etag": "e"}, path))\n')
+    cache = str(tmp_path / 'cache')
+    fd.args.cache = cache
+    fd.cache_root()
+    workers = [subprocess.Popen([sys.executable, '-c', script, cache, name],
+                                cwd=str(fd.Path(fd.__file__).parent))
+               for name in 'abcd']
+    assert [w.wait() for w in workers] == [0] * 4
+    assert len(fd.read_manifest(tmp_path / 'cache', fd.cache_index_name)) == 80
+
+
+def test_cache_evict_counts_unindexed_objects(tmp_path):
+    fd.args.cache = str(tmp_path / 'cache')
+    root = fd.cache_root()
+    orphan = fd.cache_object(root, 'ab' * 32)
+    orphan.parent.mkdir()
+    orphan.write_bytes(b'x' * 1000)
+    assert fd.cache_evict(root, 2000) == [] and orphan.exists()
+    assert fd.cache_evict(root, 500) == [] and not orphan.exists()
+
+
+datasets = ['bls:cew', 'bls:ce', 'bls:sm', 'epa:ucmr']
+
+
+def consolidate(fddir, ad, **options):
+    fd.args = argparse.Namespace(quiet=True, **options)
+    fd.actions[ad.replace(':', '_') + '_consolidate'](fddir)
+    return fddir.joinpath(*ad.split(':'))
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_consolidate_parquet_matches_csv(fddir, ad):
+    pq = pytest.importorskip('pyarrow.parquet')
+    d = consolidate(fddir, ad, format='csv')
+    consolidate(fddir, ad, format='parquet')
+    csv = pd.read_csv(d / 'data.csv', dtype=str, keep_default_na=False)
+    table = pq.read_table(d / 'data.parquet',
+                          schema=pq.read_schema(d / 'data.parquet/_common_metadata'))
+    assert len(list((d / 'data.parquet').glob('year=*/*.parquet'))) >= 2
+    parquet = table.to_pandas()
+    assert sorted(parquet.columns) == sorted(csv.columns)
+    assert len(parquet) == len(csv)
+    if 'year' in csv:
+        assert (sorted(parquet.year.astype(int).unique()) ==
+                sorted(csv.year.astype(int).unique()))
+
+
+def test_bls_cew_consolidate_jobs_matches_serial(fddir):
+    d = consolidate(fddir, 'bls:cew', jobs=1)
+    serial = (d / 'data.csv').read_bytes()
+    (d / 'data.csv').unlink()
+    consolidate(fddir, 'bls:cew', jobs=2)
+    assert (d / 'data.csv').read_bytes() == serial
+    assert sorted(p.name for p in d.iterdir()) == [
+        '.fd-consolidate.json', '2015_qtrly_by_industry.zip',
+        '2016_qtrly_by_industry.zip', 'data.csv']
+
+
+def test_epa_ucmr_chunks_stream(tmp_path):
+    d = make_epa_ucmr(tmp_path, n=25000)
+    chunks = list(fd.epa_ucmr_chunks(d))
+    assert len(chunks) == 3 + 2     # 10,000 row chunks of each file
+    assert all(list(c.columns) == list(chunks[0].columns) for c in chunks)
+    data = pd.concat(chunks, ignore_index=True)
+    assert len(data) == 25000 + 12500
+    # PWSID AL0000008 has no zip code
+    assert data.ZIPCODE.isna().sum() == data.PWSID.str.endswith('8').sum()
+
+    keys = ['PWSID', 'FacilityID', 'SamplePointID', 'CollectionDate']
+    with zipfile.ZipFile(str(d / 'ucmr-3-occurrence-data.zip')) as z:
+        all3 = pd.read_table(z.open('UCMR3_All.txt'), dtype=str)
+        drt = pd.read_table(z.open('UCMR3_DRT.txt'), dtype=str)
+    expected = pd.merge(all3, drt[keys + ['Disinfectant Type']], on=keys, how='left')
+    assert (data.DisinfectantType[:25000].astype(object).fillna('').tolist() ==
+            expected['Disinfectant Type'].fillna('').tolist())
+
+
+def test_attach_dimension_matches_merge():
+    table = pd.DataFrame({'series_id': ['a', 'b', 'c'],
+                          'name': ['A', 'B', None],
+                          'begin_year': [1990, 2000, 2010]})
+    chunk = pd.DataFrame({'series_id': ['c', 'a', 'z', 'a'],
+                          'value': [1.0, 2.0, 3.0, 4.0]})
+    merged = pd.merge(chunk, table, how='left', on='series_id')
+    attached = fd.attach_dimension(chunk, fd.index_dimension(table, 'series_id'))
+    assert attached.name.dtype == 'category'
+    pd.testing.assert_frame_equal(attached.astype(merged.dtypes), merged)
+
+
+def test_catalog_resolves_urls_once(tmp_path, monkeypatch):
+    calls = []
+
+    def resolve():
+        calls.append(1)
+        if len(calls) > 3:
+            raise r.ConnectionError
+        yield 'https://example.com/{0}.zip'.format(len(calls))
+
+    monkeypatch.setattr(fd, 'resolve_bls_cew_urls', resolve)
+    fd.args = argparse.Namespace(quiet=True, directory=tmp_path)
+    assert fd.get_bls_cew_urls() == ['https://example.com/1.zip']
+    assert fd.get_bls_cew_urls() == ['https://example.com/1.zip']
+    assert len(calls) == 1
+    assert fd.read_manifest(tmp_path, fd.catalog_name)['bls:cew']['urls']
+
+    fd.args.refresh = True
+    assert fd.get_bls_cew_urls() == ['https://example.com/2.zip']
+    fd.args = argparse.Namespace(quiet=True, directory=tmp_path, catalog_ttl=0)
+    assert fd.get_bls_cew_urls() == ['https://example.com/3.zip']
+    # an expired entry still serves when the webpage can't be reached
+    assert fd.get_bls_cew_urls() == ['https://example.com/3.zip']
+
+    fd.args = argparse.Namespace(quiet=True, directory=tmp_path, offline=True,
+                                 catalog_ttl=0)
+    assert fd.get_bls_cew_urls() == ['https://example.com/3.zip']
+    assert len(calls) == 4
+    with pytest.raises(SystemExit):
+        fd.get_bls_ce_urls()
+
+
+def test_catalog_never_records_no_urls(server, tmp_path, monkeypatch):
+    monkeypatch.setitem(fd.bls, 'base', server.url + '/')
+    fd.args = argparse.Namespace(quiet=True, directory=tmp_path)
+    with pytest.raises(r.HTTPError):
+        fd.get_bls_cew_urls()       # the page is missing
+    server.files['/cew/datatoc.htm'] = b'blocked'
+    with pytest.raises(SystemExit):
+        fd.get_bls_cew_urls()
+    assert fd.read_manifest(tmp_path, fd.catalog_name) == {}
+
+    server.files['/cew/datatoc.htm'] = (
+        b'<a href="/cew/data/files/2016/csv/2016_qtrly_by_industry.zip">')
+    urls = fd.get_bls_cew_urls()
+    assert len(urls) == 1
+    # a blocked page later keeps the URLs found before
+    server.files['/cew/datatoc.htm'] = b'blocked'
+    fd.args.refresh = True
+    assert fd.get_bls_cew_urls() == urls
+
+
+def test_fetch_urls_applies_backpressure(server, tmp_path):
+    fd.args.workers = 2
+    for i in range(8):
+        server.files['/f{0}'.format(i)] = str(i).encode() * 1000
+    urls = [server.url + '/f{0}'.format(i) for i in range(8)]
+    paths = fd.fetch_urls(urls, tmp_path, depth=1)
+    first = next(paths)
+    time.sleep(0.5)
+    # one file consumed, one queued and one held by each waiting worker
+    assert len(list(tmp_path.glob('f*'))) <= 1 + 1 + 2
+    assert sorted(p.name for p in [first, *paths]) == sorted(
+        'f{0}'.format(i) for i in range(8))
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_fetch_matches_download_then_consolidate(fddir, server, tmp_path,
+                                                 monkeypatch, ad):
+    src = fddir.joinpath(*ad.split(':'))
+    names = [p.name for p in sorted(src.iterdir())]
+    for name in names:
+        server.files['/' + name] = (src / name).read_bytes()
+    urls = [server.url + '/' + name for name in names]
+    if ad in ('bls:ce', 'bls:sm'):
+        # the data file comes first, as it does from get_*_urls
+        urls.sort(key=lambda url: '.data.' not in url)
+    ad_ = ad.replace(':', '_')
+    monkeypatch.setattr(fd, 'get_{0}_urls'.format(ad_), lambda: iter(urls))
+    d = tmp_path.joinpath('fetched', *ad.split(':'))
+    d.mkdir(parents=True)
+    fd.args = argparse.Namespace(quiet=True, backoff=0, retries=20, jobs=2,
+                                 buffer_size=512)
+    server.drops = 100              # resumed mid-stream, unseen by the parser
+    server.drop_after = 2000
+    fd.actions[ad_ + '_fetch'](tmp_path / 'fetched')
+    assert any(server.ranges)
+    assert sorted(p.name for p in d.iterdir()) == sorted(
+        names + ['data.csv', fd.manifest_name, fd.consolidate_manifest_name])
+    for name in names:
+        assert (d / name).read_bytes() == (src / name).read_bytes()
+
+    expected = consolidate(fddir, ad).joinpath('data.csv').read_text()
+    lines = (d / 'data.csv').read_text().splitlines()
+    assert lines[0] == expected.splitlines()[0]
+    assert sorted(lines) == sorted(expected.splitlines())
+
+    # fetched files are signed as if consolidated after downloading them
+    def hashes(d):
+        with (d / fd.consolidate_manifest_name).open() as f:
+            sources = fd.json.load(f)['csv']['sources']
+        return {name: {f: sig['sha256'] for f, sig in s['files'].items()}
+                for name, s in sources.items()}
+    assert hashes(d) == hashes(src)
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet', 'sqlite'])
+def test_consolidate_reprocesses_only_changed_sources(fddir, fmt, monkeypatch):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    d = fddir / 'bls/cew'
+    make_bls_cew(d, years=(2014, 2015, 2016))
+
+    def read():
+        if fmt == 'csv':
+            return pd.read_csv(d / 'data.csv', dtype=str)
+        if fmt == 'sqlite':
+            with closing(sqlite3.connect(str(d / 'data.sqlite'))) as con:
+                return pd.read_sql('SELECT * FROM data', con).astype(str)
+        return pd.read_parquet(d / 'data.parquet').astype(str)
+
+    consolidate(fddir, 'bls:cew', format=fmt)
+    first = read()
+    assert len(first) == 150
+
+    parsed = []
+    archive_chunks = fd.bls_cew_archive_chunks
+    monkeypatch.setattr(fd, 'bls_cew_archive_chunks',
+                        lambda z, *pargs: parsed.append(z.name) or
+                        archive_chunks(z, *pargs))
+    consolidate(fddir, 'bls:cew', format=fmt)
+    assert parsed == []
+    assert read().equals(first)
+
+    # a middle archive changes, another is added
+    make_bls_cew(d, years=(2015,), n=20)
+    make_bls_cew(d, years=(2017,), n=10)
+    consolidate(fddir, 'bls:cew', format=fmt)
+    assert parsed == ['2015_qtrly_by_industry.zip', '2017_qtrly_by_industry.zip']
+    again = read()
+    assert len(again) == 50 + 20 + 50 + 10
+    assert sorted(again.year.value_counts().items()) == [
+        ('2014', 50), ('2015', 20), ('2016', 50), ('2017', 10)]
+
+    (d / '2014_qtrly_by_industry.zip').unlink()
+    consolidate(fddir, 'bls:cew', format=fmt)
+    assert sorted(read().year.unique()) == ['2015', '2016', '2017']
+
+    parsed.clear()
+    consolidate(fddir, 'bls:cew', format=fmt, rebuild=True)
+    assert len(parsed) == 3
+
+
+@pytest.mark.parametrize('compress', ['gzip', 'bz2', 'zstd'])
+def test_consolidate_compresses_csv(fddir, compress, monkeypatch):
+    if compress == 'zstd':
+        pytest.importorskip('zstandard')
+    d = fddir / 'bls/cew'
+    make_bls_cew(d, years=(2014, 2015, 2016))
+    consolidate(fddir, 'bls:cew')
+    plain = (d / 'data.csv').read_bytes()
+    # several chunks, so several members, to each archive
+    monkeypatch.setattr(fd, 'chunk_rows', 20)
+    consolidate(fddir, 'bls:cew', compress=compress)
+    path = d / ('data.csv' + fd.compressions[compress])
+    assert not (d / 'data.csv').exists()
+    assert path.stat().st_size < len(plain)
+    with fd.open_compressed(path, compress) as f:
+        assert f.read() == plain
+
+    # only the changed archive is compressed again
+    make_bls_cew(d, years=(2015,), n=20)
+    consolidate(fddir, 'bls:cew', compress=compress)
+    with fd.open_compressed(path, compress) as f:
+        data = pd.read_csv(f, dtype=str)
+    assert sorted(data.year.value_counts().items()) == [
+        ('2014', 50), ('2015', 20), ('2016', 50)]
+
+    fd.args = argparse.Namespace(quiet=True)
+    where = [fd.parse_where('year == 2015', fd.bls_cew)]
+    assert sum(len(c) for c in fd.query_chunks(
+        d, fd.bls_cew, ['year'], where)) == 20
+
+
+def test_consolidate_rolls_up_bls_cew(fddir, monkeypatch):
+    d = fddir / 'bls/cew'
+    make_bls_cew(d, years=(2014, 2015, 2016))
+    measures = fd.bls_cew['rollups']['measures']
+
+    def expected(keys):
+        data = pd.read_csv(d / 'data.csv', dtype=dict.fromkeys(
+            ['year', 'qtr', 'own_code', 'area_fips', 'agglvl_code'], str))
+        data['state'] = data.area_fips.str[:2]
+        data['qtr'] = data.qtr.astype(float).astype('Int64').astype(str)
+        grouped = data.groupby(keys, dropna=False)
+        totals = grouped[measures].sum()
+        totals['rows'] = grouped.size()
+        return totals.reset_index()
+
+    def check():
+        for name, keys in [('year-state', ['year', 'state', 'agglvl_code']),
+                           ('own_code', ['own_code', 'agglvl_code']),
+                           ('year-qtr-own_code',
+                            ['year', 'qtr', 'own_code', 'agglvl_code'])]:
+            rollup = pd.read_csv(d / 'rollups' / (name + '.csv'),
+                                 dtype=dict.fromkeys(keys, str))
+            assert list(rollup.columns) == keys + measures + ['rows']
+            pd.testing.assert_frame_equal(rollup, expected(keys),
+                                          check_dtype=False)
+
+    # several chunks to each archive
+    monkeypatch.setattr(fd, 'chunk_rows', 20)
+    consolidate(fddir, 'bls:cew', rollup=['year,state', 'own_code', 'year,qtr,own_code'])
+    check()
+
+    # only the changed archive is aggregated again
+    make_bls_cew(d, years=(2015,), n=20)
+    (d / '2014_qtrly_by_industry.zip').unlink()
+    added = []
+    rollup_chunk = fd.rollup_chunk
+    monkeypatch.setattr(fd, 'rollup_chunk', lambda chunk, *a: added.append(
+        chunk.year.unique().tolist()) or rollup_chunk(chunk, *a))
+    consolidate(fddir, 'bls:cew', rollup=['year,state', 'own_code', 'year,qtr,own_code'])
+    assert {y for years in added for y in years} == {'2015'}
+    check()
+    assert sorted(p.name for p in (d / 'rollups/parts/own_code').iterdir()) \
+        == ['2015_qtrly_by_industry.zip.csv', '2016_qtrly_by_industry.zip.csv']
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet', 'sqlite'])
+def test_query_selects_columns_and_rows(fddir, fmt, tmp_path):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    d = consolidate(fddir, 'bls:cew', format='csv')
+    consolidate(fddir, 'bls:cew', format=fmt)
+    data = pd.read_csv(d / 'data.csv', dtype=str)
+    fips = sorted(data.area_fips.unique())[:3]
+    expected = data[data.area_fips.isin(fips) & (data.year >= '2016') &
+                    (data.agglvl_code != '71')]
+    expected = expected[['area_fips', 'year', 'total_qtrly_wages']]
+
+    out = tmp_path / 'out.csv'
+    fd.args = argparse.Namespace(
+        quiet=True, format=fmt, output=str(out),
+        columns=['area_fips,year', 'total_qtrly_wages'],
+        where=['area_fips in ' + ','.join(fips), 'year>=2016',
+               'agglvl_code != 71'])
+    fd.actions['bls_cew_query'](fddir)
+    got = pd.read_csv(out, dtype=str)
+    assert len(got) and list(got.columns) == list(expected.columns)
+    key = list(expected.columns)
+    pd.testing.assert_frame_equal(
+        got.sort_values(key).reset_index(drop=True),
+        expected.sort_values(key).reset_index(drop=True))
+
+
+def test_query_needs_consolidated_data(fddir, capsys):
+    d = fddir / 'bls/ce'
+    fd.args = argparse.Namespace(quiet=True)
+    with pytest.raises(SystemExit):
+        list(fd.query_chunks(d, fd.bls_ce))
+    assert 'consolidate it first' in capsys.readouterr().out
+
+    # a data.csv consolidated before the manifest was kept
+    consolidate(fddir, 'bls:ce')
+    (d / fd.consolidate_manifest_name).unlink()
+    fd.args = argparse.Namespace(quiet=True)
+    where = [fd.parse_where('year == 2001', fd.bls_ce)]
+    chunks = list(fd.query_chunks(d, fd.bls_ce, ['year'], where))
+    assert sum(len(c) for c in chunks) and \
+        all((c.year == 2001).all() for c in chunks)
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_load_matches_consolidate(fddir, ad):
+    frame = fd.load(ad, directory=fddir, frame=True)
+    d = fddir.joinpath(*ad.split(':'))
+    assert not (d / 'data.csv').exists()
+    consolidate(fddir, ad)
+    data = pd.read_csv(d / 'data.csv', dtype=str, keep_default_na=False)
+    assert list(frame.columns) == list(data.columns)
+    assert len(frame) == len(data)
+    written = frame.to_csv(index=False, float_format='%.2f')
+    assert written.encode() == (d / 'data.csv').read_bytes()
+
+
+def test_load_selects_lazily(fddir):
+    chunks = fd.load('bls:cew', columns=['area_fips', 'year', 'agglvl_code'],
+                     filters=['year == 2016', ('agglvl_code', '!=', '71')],
+                     directory=fddir, fips=['6001', '06000'])
+    assert not isinstance(chunks, pd.DataFrame)
+    frame = fd.concat_chunks(chunks)
+    assert list(frame.columns) == ['area_fips', 'year', 'agglvl_code']
+    assert set(frame.area_fips) <= {'06001', '06000'} and len(frame)
+    assert (frame.year == '2016').all() and (frame.agglvl_code != '71').all()
+    assert frame.agglvl_code.dtype == 'category'
+    with pytest.raises(ValueError):
+        fd.load('bls:cew', columns=['nope'], directory=fddir)
+
+
+def test_load_types_tuple_filters(fddir):
+    cew = fd.load('bls:cew', filters=[('year', '>=', 2016)], directory=fddir,
+                  frame=True)
+    assert len(cew) and (cew.year == '2016').all()
+    ce = fd.load('bls:ce', filters=[('year', '>=', '2001'),
+                                    ('period', 'in', 'M01,M02')],
+                 directory=fddir, frame=True)
+    assert len(ce) and (ce.year >= 2001).all()
+    assert set(ce.period) == {'M01', 'M02'}
+
+
+def test_load_raises_and_prints_nothing(fddir, tmp_path, capsys):
+    fd.args = argparse.Namespace(quiet=False)
+    assert len(fd.load('bls:cew', directory=fddir, frame=True))
+    for bad in [dict(filters=['year ~ 2016']),
+                dict(filters=['nope == 1']),
+                dict(filters=[('year', '~', '2016')]),
+                dict(filters=[('qtr', '>=', 'first')]),
+                dict(fips=str(tmp_path / 'empty.csv'))]:
+        (tmp_path / 'empty.csv').write_text('')
+        with pytest.raises(ValueError):
+            fd.load('bls:cew', directory=fddir, **bad)
+    with pytest.raises(FileNotFoundError):
+        fd.load('bls:cew', directory=tmp_path / 'nowhere')
+    assert capsys.readouterr() == ('', '')
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_consolidate_streams_to_stdout(fddir, ad, capfdbinary):
+    d = consolidate(fddir, ad)
+    data = (d / 'data.csv').read_bytes()
+    manifest = (d / fd.consolidate_manifest_name).read_bytes()
+    capfdbinary.readouterr()
+    fd.args = argparse.Namespace(quiet=False, output='-')
+    fd.actions[ad.replace(':', '_') + '_consolidate'](fddir)
+    out, err = capfdbinary.readouterr()
+    assert out == data
+    assert b'consolidated' in err
+    assert (d / fd.consolidate_manifest_name).read_bytes() == manifest
+
+
+def test_streaming_stops_quietly_when_the_reader_does(tmp_path):
+    make_fddir(tmp_path, 50000)
+    fd_main = 'import sys, fd; sys.argv = ["fd"] + sys.argv[1:]; fd.main()'
+    p = subprocess.Popen(
+        [sys.executable, '-c', fd_main, '-q', '-d', str(tmp_path),
+         'consolidate', 'bls:ce', '-o', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=str(fd.Path(fd.__file__).parent))
+    assert p.stdout.readline().startswith(b'series_id,')
+    p.stdout.close()                # as head does
+    assert p.wait() == 1
+    assert p.stderr.read() == b''
+
+
+def test_streaming_prompts_and_errors_go_to_stderr(tmp_path, monkeypatch,
+                                                   capsys):
+    fd.args = argparse.Namespace(quiet=False, output='-')
+    (tmp_path / 'f').write_text('x')
+    answers = iter(['maybe', 'no'])
+    monkeypatch.setattr('builtins.input', lambda: next(answers))
+    with pytest.raises(SystemExit):
+        fd.check_directory_download(tmp_path)
+    with pytest.raises(SystemExit):
+        fd.check_directory_download(tmp_path / 'nowhere')
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'Proceed anyway?' in err and "'yes' or 'no'" in err
+    assert 'does not exist' in err
+
+
+def test_sqlite_keeps_indexes_of_unchanged_data(fddir, monkeypatch):
+    consolidate(fddir, 'bls:cew', format='sqlite')
+    statements = []
+    connect = sqlite3.connect
+
+    def traced(*pargs, **kwargs):
+        con = connect(*pargs, **kwargs)
+        con.set_trace_callback(statements.append)
+        return con
+
+    monkeypatch.setattr(fd.sqlite3, 'connect', traced)
+    d = consolidate(fddir, 'bls:cew', format='sqlite')
+    assert not [s for s in statements if 'INDEX' in s or 'DELETE' in s]
+
+    (d / '2016_qtrly_by_industry.zip').unlink()
+    consolidate(fddir, 'bls:cew', format='sqlite')
+    assert [s for s in statements if s.startswith('DELETE')]
+    with closing(connect(str(d / 'data.sqlite'))) as con:
+        assert con.execute("SELECT count(*) FROM sqlite_master "
+                           "WHERE type = 'index' AND name LIKE 'index_%'"
+                           ).fetchone()[0] == 2
+        assert {y for y, in con.execute('SELECT DISTINCT year FROM data')} \
+            == {'2015'}
+
+
+@pytest.mark.parametrize('ad', ['bls:ce', 'bls:sm'])
+def test_sqlite_normalizes_dimensions(fddir, ad):
+    pytest.importorskip('pyarrow')
+    d = consolidate(fddir, ad, format='sqlite')
+    consolidate(fddir, ad, format='parquet')
+    with closing(sqlite3.connect(str(d / 'data.sqlite'))) as con:
+        facts = [row[1] for row in con.execute('PRAGMA table_info(facts)')]
+        assert 'industry_name' not in facts and 'series_id' in facts
+        nseries = con.execute('SELECT count(*) FROM series').fetchone()[0]
+        assert nseries == con.execute(
+            'SELECT count(DISTINCT series_id) FROM facts').fetchone()[0]
+        plan = con.execute('EXPLAIN QUERY PLAN SELECT * FROM data '
+                           'WHERE series_id = ?', ['x']).fetchall()
+        assert any('index_series_id' in row[-1] for row in plan)
+        data = pd.read_sql('SELECT * FROM data', con)
+    expected = pd.read_parquet(d / 'data.parquet')
+    assert sorted(data.columns) == sorted(expected.columns)
+    key = ['series_id', 'year', 'period']
+    data = data.sort_values(key).reset_index(drop=True)
+    expected = expected.sort_values(key).reset_index(drop=True)
+    for k in ['industry_name', 'data_type_text', 'value']:
+        assert (data[k].astype(str).tolist() ==
+                expected[k].astype(str).replace('None', 'nan').tolist())
+
+    # a lookup on an index is answered by SQLite without naming the format
+    fd.args = argparse.Namespace(quiet=True)
+    series_id = data.series_id[0]
+    where = [fd.parse_where('series_id = ' + series_id, fd.chunk_readers[ad][0])]
+    chunks = list(fd.query_chunks(d, fd.chunk_readers[ad][0], None, where))
+    assert sum(len(c) for c in chunks) == (data.series_id == series_id).sum()
+
+
+@pytest.mark.parametrize('ad', ['bls:ce', 'bls:sm'])
+def test_matrix_pivots_values(fddir, ad):
+    d = consolidate(fddir, ad, format='csv')
+    consolidate(fddir, ad, format='matrix')
+    data = pd.read_csv(d / 'data.csv', dtype={'series_id': str, 'period': str})
+    expected = data.dropna(subset=['value']).pivot(
+        index='series_id', columns=['year', 'period'], values='value')
+    matrix = fd.load_matrix(ad, directory=fddir)
+    assert isinstance(np.load(d / 'data.matrix/values.npy', mmap_mode='r'),
+                      np.memmap)
+    pd.testing.assert_frame_equal(
+        matrix, expected.sort_index().sort_index(axis=1), check_names=False)
+
+    series = [matrix.index[3], matrix.index[1], 'missing']
+    assert list(fd.load_matrix(ad, series, fddir).index) == series[:2]
+    fd.args = argparse.Namespace(quiet=True, format='matrix')
+    where = [fd.parse_where('series_id in ' + ','.join(series), fd.bls_ce),
+             fd.parse_where('year >= 2001', fd.bls_ce)]
+    selected = fd.concat_chunks(fd.query_chunks(
+        d, fd.chunk_readers[ad][0], ['series_id', 'period', 'value'], where))
+    expected = data[data.series_id.isin(series) & (data.year >= 2001) &
+                    data.value.notna()]
+    assert sorted(map(tuple, selected.astype(str).to_numpy())) == sorted(
+        map(tuple, expected[['series_id', 'period', 'value']]
+            .astype(str).to_numpy()))
+
+
+def test_consolidate_keeps_only_fips_areas(fddir, tmp_path):
+    d = consolidate(fddir, 'bls:cew')
+    everything = pd.read_csv(d / 'data.csv', dtype=str)
+
+    codes = tmp_path / 'counties.csv'
+    codes.write_text('fips\n6001\n41051\n')
+    assert fd.load_fips(str(codes)) == {'06001', '41051'}
+    codes.write_text('6001\n41051\n')
+    assert fd.load_fips(str(codes)) == {'06001', '41051'}
+    (tmp_path / 'empty.csv').touch()
+    with pytest.raises(SystemExit):
+        fd.load_fips(str(tmp_path / 'empty.csv'))
+
+    for jobs in (1, 2):
+        consolidate(fddir, 'bls:cew', fips=str(codes), jobs=jobs)
+        kept = pd.read_csv(d / 'data.csv', dtype=str)
+        expected = everything[everything.area_fips.isin(['06001', '41051'])]
+        assert 0 < len(kept) < len(everything)
+        pd.testing.assert_frame_equal(kept.reset_index(drop=True),
+                                      expected.reset_index(drop=True))
+
+    # dropping the filter consolidates every area again
+    consolidate(fddir, 'bls:cew', fips='6001,06000')
+    assert set(pd.read_csv(d / 'data.csv', dtype=str).area_fips) == {
+        '06001', '06000'}
+    consolidate(fddir, 'bls:cew')
+    assert len(pd.read_csv(d / 'data.csv', dtype=str)) == len(everything)
+
+
+def test_metrics_report_each_stage(fddir, server, tmp_path, monkeypatch):
+    report = tmp_path / 'metrics.json'
+    fd.args = argparse.Namespace(
+        quiet=True, action='consolidate', ad='bls:cew', directory=fddir,
+        jobs=2, metrics=str(report), profile=str(tmp_path / 'profile.txt'),
+        profile_interval=1.0)
+    fd.dispatch(fd.args)
+    with report.open() as f:
+        metrics = fd.json.load(f)
+    assert metrics['action'] == 'bls_cew_consolidate'
+    stages = metrics['stages']
+    # parse, convert and spool ran in the worker processes
+    assert {'parse', 'convert', 'spool', 'write'} <= set(stages)
+    assert stages['parse']['rows'] == stages['write']['rows'] == 100
+    with (fddir / 'bls/cew' / fd.consolidate_manifest_name).open() as f:
+        header = fd.json.load(f)['csv']['layout']['header']
+    assert (stages['write']['bytes'] + header ==
+            (fddir / 'bls/cew/data.csv').stat().st_size)
+    assert all(m['wall'] >= 0 and m['peak_rss'] > 0 for m in stages.values())
+    # each stage's own peak, also in the workers
+    assert len({m['peak_rss'] for m in stages.values()}) > 1
+    assert metrics['wall'] > 0 and metrics['peak_rss'] > 0
+    assert 'MainThread;' in (tmp_path / 'profile.txt').read_text()
+
+    server.files['/f.bin'] = b'x' * 5000
+    monkeypatch.setattr(fd, 'get_bls_ce_urls', lambda: [server.url + '/f.bin'])
+    (tmp_path / 'fd/bls/ce').mkdir(parents=True)
+    fd.args = argparse.Namespace(
+        quiet=True, action='download', ad='bls:ce', directory=tmp_path / 'fd',
+        metrics=str(report))
+    fd.dispatch(fd.args)
+    with report.open() as f:
+        stages = fd.json.load(f)['stages']
+    assert stages['download']['bytes'] == 5000
+    assert stages['download']['calls'] == 1
+
+
+@pytest.mark.parametrize('argv', [['available'], ['available', 'bls'],
+                                  ['help', 'query']])
+def test_startup_loads_no_heavy_modules(argv):
+    script = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        'import fd\n'
+        'sys.argv = ["fd"] + sys.argv[1:]\n'
+        'try:\n'
+        '    fd.main()\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'loaded = [m for m in ("pandas", "numpy", "requests", "multiprocessing")\n'
+        '          if m in sys.modules and\n'
+        '          type(sys.modules[m]).__name__ != "_LazyModule"]\n'
+        'print(loaded, time.perf_counter() - start)\n')
+    out = subprocess.run(
+        [sys.executable, '-c', script] + argv, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True,
+        cwd=str(fd.Path(fd.__file__).parent)).stdout
+    loaded, seconds = out.strip().splitlines()[-1].rsplit(' ', 1)
+    assert loaded == '[]'
+    assert float(seconds) < 0.5
+
+
+def test_help_examples_are_indented_two_spaces():
+    for name, sub in fd.build_parser()._subparsers._group_actions[0] \
+            .choices.items():
+        for line in (sub.epilog or '').splitlines():
+            if '$ fd' in line:
+                assert line.startswith('  $ fd'), (name, line)
+
+
+def test_narrow_int():
+    assert fd.narrow_int(pd.Series([1, 2016])).dtype == 'int16'
+    assert fd.narrow_int(pd.Series([-3.0, 100.0])).dtype == 'int8'
+    assert fd.narrow_int(pd.Series(['70000', '1'])).dtype == 'int32'
+    assert fd.narrow_int(pd.Series([2**40, None])).dtype == 'Int64'
+    assert fd.narrow_int(pd.Series([None, None], dtype=float)).dtype == 'Int8'
+    with pytest.raises((TypeError, ValueError)):
+        fd.narrow_int(pd.Series([1.5]))
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_convert_dtypes_follows_schema(fddir, ad):
+    agency_dict = getattr(fd, ad.replace(':', '_'))
+    d = fddir.joinpath(*ad.split(':'))
+    chunk = next(getattr(fd, ad.replace(':', '_') + '_chunks')(d))
+    for k, v in agency_dict['dtype'].items():
+        if k not in chunk:
+            continue
+        dtype = chunk[k].dtype
+        if v == int:
+            assert pd.api.types.is_integer_dtype(dtype), k
+        elif v == float:
+            assert dtype == 'float64', k
+        elif v == 'category':
+            assert dtype == 'category', k
+        else:
+            assert not pd.api.types.is_numeric_dtype(dtype), k
+    if 'year' in chunk:
+        assert chunk.year.astype(int).between(2000, 2020).all()
+
+    # categoricals use less memory than the strings they replace
+    cats = [k for k, v in agency_dict['dtype'].items()
+            if v == 'category' and k in chunk]
+    as_strings = chunk.astype({k: object for k in cats})
+    assert (chunk.memory_usage(deep=True).sum() <
+            as_strings.memory_usage(deep=True).sum())
+    assert fd.convert_dtypes(as_strings, fd.get_dtypes(agency_dict)) is as_strings
+    assert all(as_strings[k].dtype == 'category' for k in cats)
+
+
+def test_read_args_parse_declared_types():
+    text = 'series_id\tyear\tperiod\tvalue\textra\nA\t2001\tM01\t-\tx\nB\t2002\tM02\t1.5\ty\n'
+    chunk = pd.read_csv(io.StringIO(text), sep='\t', **fd.read_args(fd.bls_sm))
+    assert list(chunk.columns) == ['series_id', 'year', 'period', 'value']
+    assert chunk.period.dtype == 'category'
+    assert chunk.value.isna().tolist() == [True, False]
+    chunk = fd.convert_dtypes(chunk, fd.get_dtypes(fd.bls_sm))
+    assert chunk.year.tolist() == [2001, 2002] and chunk.year.dtype == 'int16'
+
+
+def test_read_chunks_sizes_chunks_to_memory_limit():
+    text = 'a,b\n' + ''.join('{0},{1}\n'.format(i, 'x' * 50) for i in range(100000))
+
+    def sizes(memory_limit):
+        reader = pd.read_csv(io.StringIO(text), iterator=True)
+        return [len(c) for c in fd.read_chunks(reader, memory_limit)]
+
+    assert sizes(None) == [10000] * 10
+    small = sizes(2**20)
+    assert sum(small) == 100000 and small[0] == fd.probe_rows
+    assert max(small) < 10000
+    large = sizes(2**30)
+    assert large[:4] == [fd.probe_rows, 10000, 40000, 49900]
+
+
+@pytest.mark.parametrize('ad', datasets)
+def test_consolidate_memory_limit_matches_default(fddir, ad, monkeypatch):
+    d = consolidate(fddir, ad)
+    default = (d / 'data.csv').read_bytes()
+    # start small enough that the fixtures span several chunks
+    monkeypatch.setattr(fd, 'chunk_rows', 30)
+    consolidate(fddir, ad, rebuild=True, memory_limit=2**16)
+    assert (d / 'data.csv').read_bytes() == default